@@ -1,93 +1,529 @@
 import torch
+import torch.nn.functional as F
 import os
+import contextlib
+import functools
 import numpy as np
-import cv2
 import time
+import threading
 
 from models.network_rrdbnet import RRDBNet as net
-from utils import uint2tensor4, tensor2uint
+from utils import frame_converter
+from config import BATCH_PIXEL_BUDGET, BATCH_OUTPUT_BYTES, CPU_WORKERS, RESULT_CACHE, JOBS_FOLDER, METRICS_FILE, PRIORITY_PREVIEW
+from video_pipeline import stream_video, segment_video
+from model_cache import ModelCache
+from weights import load_weights, weights_identity
+from transport import Frame, FrameRing, pack_image, unpack_image
+from worker_pool import InferencePool, resolve_devices, device_names
+from engine import get_engine, int8_available, quantized_identity
+from temporal import TemporalReuse
+from result_cache import ResultCache, result_key, hash_image, hash_file
+from scheduler import Job, JobQueue, JobCancelled
+from metrics import Metrics, MetricsLog, stage
 
 from PIL import Image
 
 
-def upscale_process(conn):
-    if not os.path.isdir('./outputs'):
-        os.mkdir('./outputs')
+def _tile_starts(size, tile, overlap):
+    # Tile origins along one axis, the last one is shifted back so every tile has the same size
+    stride = max(tile - overlap, 1)
+    starts = list(range(0, size - tile, stride))
+    starts.append(size - tile)
+    return starts
 
-    model = None
-    gpu_id = None
-    
-    while True:
-        conn.poll(timeout=None)
-        new_model, new_gpu_id, filepath, images = conn.recv()
 
-        if model != new_model or gpu_id != new_gpu_id:
-            model, gpu_id = new_model, new_gpu_id
+def _tile_weights(start, tile, size, ramp, device):
+    # 1D blending weights: linear ramps on the sides that overlap a neighbour tile
+    weights = torch.ones(tile, device=device)
+    ramp = min(ramp, tile // 2)
+    if ramp > 0:
+        fade = torch.arange(1, ramp + 1, device=device, dtype=torch.float32) / (ramp + 1)
+        if start > 0:
+            weights[:ramp] = fade
+        if start + tile < size:
+            weights[-ramp:] = fade.flip(0)
+    return weights
 
-            # Send info
-            conn.send(f'Pytorch version: {torch.__version__}')
-            conn.send(f'Cuda version: {torch.version.cuda}')
-            conn.send(f'Cudnn version: {torch.backends.cudnn.version()}')
 
-            model_name = model
-            sf = 4
+def tiled_forward(model, img, sf, tile, overlap, scale=None):
+    """
+    Run the model over overlapping tiles of img (NCHW) and blend the outputs, so peak
+    memory depends on the tile size instead of the image size. tile <= 0 disables tiling.
+    Tiled outputs are blended at scale times the input size, sf by default. With a smaller
+    scale every tile is resized on the device first, as from_tensor would resize the whole output.
+    """
+    _, _, h, w = img.shape
 
-            device = 'cuda' if torch.cuda.is_available() else 'cpu'
-            
-            conn.send(f'Running on: {device}')
+    if tile <= 0 or (h <= tile and w <= tile):
+        return model(img)
 
-            if model_name in ['BSRGANx2']:
-                sf = 2
+    scale = sf if scale is None else scale
+    tile_h, tile_w = min(tile, h), min(tile, w)
+    overlap = min(overlap, tile_h - 1, tile_w - 1)
 
-            conn.send(f'Scale factor: {sf}')
-            conn.send(f'Model name: {model_name}')
+    # Accumulate on the host, only one tile at a time lives on the device
+    output = None
+    weight = torch.zeros(1, 1, h * scale, w * scale)
 
-            model_path = os.path.join('model_zoo', model_name+'.pth')  # set model path
+    for y in _tile_starts(h, tile_h, overlap):
+        weights_y = _tile_weights(y * scale, tile_h * scale, h * scale, overlap * scale, 'cpu')
 
-            if device == 'cuda':
-                torch.cuda.set_device(gpu_id)  # set GPU ID
-                torch.cuda.empty_cache()
-                conn.send(f'GPU ID: {torch.cuda.current_device()}')
+        for x in _tile_starts(w, tile_w, overlap):
+            weights_x = _tile_weights(x * scale, tile_w * scale, w * scale, overlap * scale, 'cpu')
 
-            # --------------------------------
-            # define network and load model
-            # --------------------------------
-            model = net(in_nc=3, out_nc=3, nf=64, nb=23, gc=32, sf=sf)  # define network
-            model.load_state_dict(torch.load(model_path), strict=True)
-            model.eval()
-            
-            model = model.to(device)
+            patch = model(img[:, :, y:y + tile_h, x:x + tile_w]).float()
+            if scale != sf:
+                patch = F.interpolate(patch, size=(tile_h * scale, tile_w * scale), mode='bilinear', align_corners=False)
+            patch = patch.cpu()
 
-        with torch.no_grad():
-            len_images = len(images)
-            video = True if len_images > 1 else False
+            if output is None:
+                output = torch.zeros(patch.shape[0], patch.shape[1], h * scale, w * scale)
 
+            mask = (weights_y[:, None] * weights_x[None, :])[None, None]
+            y_E, x_E = y * scale, x * scale
+            output[:, :, y_E:y_E + tile_h * scale, x_E:x_E + tile_w * scale] += patch * mask
+            weight[:, :, y_E:y_E + tile_h * scale, x_E:x_E + tile_w * scale] += mask
+
+    return output.div_(weight)
+
+
+def auto_batch_size(width, height, tile):
+    # Frames per forward pass so a batch stays within BATCH_PIXEL_BUDGET input pixels. Tiled frames are
+    # also accumulated whole, 3 float32 channels at the input size (see upscale_batch), within BATCH_OUTPUT_BYTES
+    if tile > 0 and (width > tile or height > tile):
+        accumulated = BATCH_OUTPUT_BYTES // (width * height * 3 * 4)
+        return max(1, min(BATCH_PIXEL_BUDGET // (min(width, tile) * min(height, tile)), accumulated))
+    return max(1, BATCH_PIXEL_BUDGET // (width * height))
+
+
+def batch_frames(images, batch_size, tile):
+    """
+    Group consecutive same-size images into batches of at most batch_size frames.
+    batch_size <= 0 sizes the batches automatically from the frame size.
+    """
+    batch = []
+    for image in images:
+        if batch and (batch[0].size != image.size or len(batch) >= limit):
+            yield batch
+            batch = []
+
+        if not batch:
+            limit = batch_size if batch_size > 0 else auto_batch_size(*image.size, tile)
+
+        batch.append(image)
+
+    if batch:
+        yield batch
+
+
+@functools.lru_cache(maxsize=None)
+def bf16_supported(device_type):
+    if device_type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    try:
+        return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def resolve_precision(device, precision):
+    # Precision that will actually run on device, unsupported modes fall back to fp32
+    device_type = torch.device(device).type
+    if precision == 'fp16' and device_type == 'cuda':
+        return 'fp16'
+    if precision == 'bf16' and bf16_supported(device_type):
+        return 'bf16'
+    return 'fp32'
+
+
+def autocast(device, precision):
+    device_type = torch.device(device).type
+    precision = resolve_precision(device, precision)
+
+    if precision == 'fp16':
+        return torch.autocast(device_type, dtype=torch.float16)
+    if precision == 'bf16':
+        return torch.autocast(device_type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def upscale_batch(model, images, sf, device, options, metrics=None):
+    # Stack same-size PIL images into one NCHW tensor, run a single forward pass and split the outputs
+    converter = frame_converter(device)
+    with stage(metrics, 'convert'):
+        arrays = [np.asarray(image if image.mode == 'RGB' else image.convert('RGB')) for image in images]
+    img_L = converter.to_tensor(arrays, metrics)
+
+    # Model predict, through the compiled engine if one is selected
+    engine = options.get('engine', 'eager')
+    precision = 'fp32' if engine == 'int8' else resolve_precision(device, options.get('precision', 'fp32'))
+    runner = get_engine(model, device, engine, precision)
+
+    # Outputs go back to the input size, so tiles are blended at that size
+    with stage(metrics, 'forward', device=True), autocast(device, precision):
+        img_E = tiled_forward(runner, img_L, sf, options['tile'], options['tile_overlap'], scale=1)
+
+    # Image is upscaled, resized back to the input size while converting
+    outputs = converter.from_tensor(img_E, images[0].size, metrics)
+
+    # Image.fromarray copies, so the converter buffer can be reused
+    with stage(metrics, 'convert'):
+        outputs = [Image.fromarray(output) for output in outputs]
+
+    if metrics is not None:
+        metrics.count(len(outputs), len(outputs) * outputs[0].width * outputs[0].height)
+    return outputs
+
+
+def upscale_frames(model, frames, sf, device, options, metrics=None):
+    # Lazily upscale an iterable of PIL frames, batching consecutive same-size frames
+    for batch in batch_frames(frames, options['batch_size'], options['tile']):
+        yield from upscale_batch(model, batch, sf, device, options, metrics)
+
+
+def model_scale(model_name):
+    return 2 if model_name in ['BSRGANx2'] else 4
+
+
+def load_model(model_name, device):
+    # Build the network for a model_zoo checkpoint and move it to device in eval mode
+    sf = model_scale(model_name)
+
+    # Built on the meta device, so nothing is allocated or randomly initialized, the memory-mapped
+    # weights are then assigned as the parameters without a copy
+    with torch.device('meta'):
+        model = net(in_nc=3, out_nc=3, nf=64, nb=23, gc=32, sf=sf)  # define network
+    model.load_state_dict(load_weights(model_name), strict=True, assign=True)
+    model.enable_dense_execution(folded=True)  # load_weights folds the residual scaling
+    model.eval()
+    model.name = model_name
+    model.weights = weights_identity(model_name)  # Tells apart the engines traced from other weights
+
+    return model.to(device)
+
+
+def result_settings(model_name, device, options):
+    # Settings that change the output, with engine and precision as they will actually run.
+    # The converted weights exist once the model is loaded
+    engine = options.get('engine', 'eager')
+    precision = resolve_precision(device, options.get('precision', 'fp32'))
+
+    if engine == 'int8':
+        engine, precision = ('int8' if int8_available(model_name, device) else 'eager'), 'fp32'
+    elif engine == 'torchscript' and precision != 'fp32':
+        engine = 'eager'
+
+    return {
+        'model': model_name,
+        # int8 outputs come from the quantized model only
+        'weights': quantized_identity(model_name) if engine == 'int8' else weights_identity(model_name),
+        'sf': model_scale(model_name),
+        'engine': engine,
+        'precision': precision,
+        'tile': options['tile'],
+        'tile_overlap': options['tile_overlap'],
+    }
+
+
+def upscale_image_cached(cache, image, model_name, device, options, process, metrics=None):
+    # Returns (output, cache hit), only runs process on a cache miss
+    if cache is None:
+        output, = process([image])
+        return output, False
+
+    with stage(metrics, 'cache'):
+        key = result_key(hash_image(image), **result_settings(model_name, device, options))
+        output = cache.get_image(key)
+    if output is not None:
+        return output, True
+
+    output, = process([image])
+    with stage(metrics, 'cache'):
+        cache.put_image(key, output)
+    return output, False
+
+
+def upscale_video_cached(cache, filepath, start, end, output_path, model_name, device, options, process, on_frame=None,
+                         metrics=None, run_segments=None):
+    # Streams frames [start, end) into output_path unless the cache has them, returns True on a cache hit.
+    # With run_segments the video is split at keyframes and the segments run in parallel instead, see segment_video
+    settings = dict(start=start, end=end, reuse_threshold=options.get('reuse_threshold'),
+                    **result_settings(model_name, device, options))
+
+    if cache is not None:
+        with stage(metrics, 'cache'):
+            key = result_key(hash_file(filepath), **settings)
+            hit = cache.get_file(key, 'mp4', output_path)
+        if hit:
+            return True
+
+    # Committed chunks of an interrupted run with the same file and settings are picked up again
+    stat = os.stat(filepath)
+    job_key = result_key(f'{os.path.abspath(filepath)}|{stat.st_size}|{stat.st_mtime}', **settings)
+    job_folder = os.path.join(JOBS_FOLDER, job_key)
+    if run_segments is not None:
+        segment_video(filepath, start, end, output_path, run_segments, on_frame, job_folder, metrics)
+    else:
+        stream_video(filepath, start, end, output_path, process, on_frame, job_folder, metrics)
+
+    if cache is not None:
+        with stage(metrics, 'cache'):
+            cache.put_file(key, 'mp4', output_path)
+    return False
+
+
+class UpscaleDaemon:
+    """
+    Runs the jobs sent by the UI, one at a time in priority order.
+
+    A receiver thread reads the connection: ('submit', job_id, priority, request) queues a job,
+    ('cancel', job_id) cancels one, ('status', ) asks for the list of jobs and ('devices', ) for the names
+    of the CUDA devices, answered with (None, {'jobs': [...]}) and (None, {'devices': [...]}). Every message sent back
+    is a (job_id, message) pair, message being a text line, an output frame or a status dict.
+    Between video frames, queued jobs of a higher priority run first so previews never wait for a video.
+    Metric events are dicts with an 'event' key: one per video frame and one per job, see metrics.Metrics.
+    """
+    def __init__(self, conn, input_ring_name=None, output_ring_name=None) -> None:
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.queue = JobQueue()
+
+        # Frames travel through shared memory, only descriptors go over the pipe
+        self.input_ring = FrameRing(input_ring_name) if input_ring_name else None
+        self.output_ring = FrameRing(output_ring_name) if output_ring_name else None
+
+        self.models = ModelCache(load_model)
+        self.cache = ResultCache() if RESULT_CACHE else None
+        self.model_name = None
+        self.gpu_id = None
+        self.device = None
+        self.pool = None  # Extra workers for video jobs, when there is more than one device or CPU worker
+        self.pool_key = None
+        self.metrics_log = MetricsLog(METRICS_FILE) if METRICS_FILE else None
+
+    def send(self, job_id, message) -> None:
+        # The receiver and the job thread both send
+        with self.send_lock:
+            self.conn.send((job_id, message))
+
+    def receive(self) -> None:
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break  # UI closed
+
+            if message[0] == 'submit':
+                _, job_id, priority, request = message
+                job = Job(job_id, priority, request)
+                self.send(job.id, {'status': 'queued', 'position': self.queue.submit(job)})
+
+            elif message[0] == 'cancel':
+                job = self.queue.cancel(message[1])
+                if job is not None and job.status == 'cancelled':
+                    self.discard(job.request[3] or ())
+                    self.send(job.id, {'status': 'cancelled'})
+
+            elif message[0] == 'status':
+                self.send(None, {'jobs': self.queue.snapshot()})
+
+            elif message[0] == 'devices':
+                self.send(None, {'devices': device_names()})
+
+        self.queue.close()
+
+    def discard(self, images) -> None:
+        # Free the input slots of images that will not be upscaled
+        for image in images:
+            if isinstance(image, Frame):
+                self.input_ring.release(image)
+
+    def run(self) -> None:
+        threading.Thread(target=self.receive, daemon=True).start()
+
+        while True:
+            job = self.queue.pop()
+            if job is None:
+                break
+            self.run_job(job)
+
+    def event(self, job: Job, event: dict) -> None:
+        event = {'event': event.pop('event'), 'job': job.id, **event}
+        self.send(job.id, event)
+        if self.metrics_log is not None:
+            self.metrics_log.write(event)
+
+    def run_job(self, job: Job) -> None:
+        self.send(job.id, {'status': 'running'})
+        job.metrics = None
+        job.read = 0  # Input frames taken out of the ring so far
+        error = None
+        try:
+            with torch.no_grad():
+                self.upscale(job)
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as e:
+            status, error = 'failed', f'{type(e).__name__}: {e}'
+        else:
+            status = 'done'
+
+        if status != 'done':
+            # The UI blocks on slots that are never read
+            self.discard((job.request[3] or ())[job.read:])
+
+        self.queue.finish(job, status)
+        if job.metrics is not None:
+            model_name, _, filepath, _, _ = job.request
+            self.event(job, {'event': 'job', 'status': status, 'model': model_name, 'path': filepath,
+                             'video': job.is_video, **job.metrics.summary()})
+            job.metrics.close()
+
+        self.send(job.id, {'status': status, 'error': error} if error else {'status': status})
+
+    def checkpoints(self, job: Job, frames):
+        # Wraps the frames of a job: stops it once cancelled and runs more urgent jobs in between
+        for frame in frames:
+            job.check()
+            self.run_urgent(job)
+            yield frame
+
+    def run_urgent(self, job: Job) -> None:
+        while True:
+            # Only image jobs jump in, the video pool stays with the running job
+            urgent = self.queue.pop(before=job.priority, videos=False)
+            if urgent is None:
+                break
+            self.run_job(urgent)
+
+    def load(self, job: Job, model_name, gpu_id) -> None:
+        if self.model_name == model_name and self.gpu_id == gpu_id:
+            return
+        self.model_name, self.gpu_id = model_name, gpu_id
+
+        # Send info
+        self.send(job.id, f'Pytorch version: {torch.__version__}')
+        self.send(job.id, f'Cuda version: {torch.version.cuda}')
+        self.send(job.id, f'Cudnn version: {torch.backends.cudnn.version()}')
+
+        # Images always run in this process, on the first device when using all of them
+        local_gpu_id = 0 if gpu_id == 'all' else gpu_id
+        self.device = f'cuda:{local_gpu_id}' if torch.cuda.is_available() else 'cpu'
+
+        self.send(job.id, f'Running on: {self.device}')
+        self.send(job.id, f'Scale factor: {model_scale(model_name)}')
+        self.send(job.id, f'Model name: {model_name}')
+
+        if self.device != 'cpu':
+            torch.cuda.set_device(local_gpu_id)  # set GPU ID
+            self.send(job.id, f'GPU ID: {torch.cuda.current_device()}')
+
+        if (model_name, self.device, torch.float32) in self.models:
+            self.send(job.id, 'Model loaded from cache')
+
+    def video_pool(self, job: Job):
+        # Started on the first video job after a model or device change
+        if self.pool is not None and self.pool_key != (self.model_name, self.gpu_id):
+            self.pool.close()
+            self.pool = None
+
+        if self.pool is None:
+            self.pool_key = (self.model_name, self.gpu_id)
+            if self.gpu_id == 'all' and self.device != 'cpu':
+                placements = resolve_devices('cuda')
+            elif self.device == 'cpu' and CPU_WORKERS > 1:
+                placements = resolve_devices(f'cpu:{CPU_WORKERS}')
+            else:
+                placements = []
+
+            if len(placements) > 1:
+                self.pool = InferencePool(self.model_name, placements)
+                self.send(job.id, f'Video workers: {", ".join(device for device, _ in placements)}')
+        return self.pool
+
+    def upscale(self, job: Job) -> None:
+        model_name, gpu_id, filepath, images, options = job.request
+
+        self.load(job, model_name, gpu_id)
+        device = self.device
+        model = self.models.get(model_name, device)
+        sf = model_scale(model_name)
+        metrics = job.metrics = Metrics(device)
+        # Preview crops change with every pan and zoom, caching them would only evict full results
+        cache = None if job.priority == PRIORITY_PREVIEW else self.cache
+
+        self.send(job.id, f'Upscaling: {filepath.split("/")[-1]}')
+
+        if device != 'cpu':
+            torch.cuda.empty_cache()
+
+        precision = options.get('precision', 'fp32')
+        if resolve_precision(device, precision) != precision:
+            self.send(job.id, f'{precision} is not supported on {device}, running in fp32')
+
+        if options.get('engine') == 'int8' and not int8_available(model_name, device):
+            self.send(job.id, f'No int8 {model_name} for {device} (see quantize.py), running eager')
+
+        def process(frames):
+            return upscale_frames(model, frames, sf, device, options, metrics)
+
+        if images is None:
+            # Is video, decoded, upscaled and encoded as a stream
+            pool = self.video_pool(job)
+            run_segments = None
+            if pool is not None:
+                def process(frames):
+                    return pool.map(frames, options, metrics)
+
+                if options.get('reuse_threshold') is None:
+                    # Every worker decodes, upscales and encodes its own segments, the daemon waits
+                    # for them running the urgent jobs in between
+                    def idle():
+                        job.check()
+                        self.run_urgent(job)
+
+                    def run_segments(segments):
+                        return pool.segments(segments, options, metrics, idle)
+
+            reuse = None
+            if options.get('reuse_threshold') is not None:
+                # Only changed frames and tiles go through the model
+                reuse = TemporalReuse(process, options['reuse_threshold'])
+                process = reuse.map
+
+            upscale = process
+
+            def process(frames):
+                return upscale(self.checkpoints(job, frames))
+
+            start, end = options['subclip']
+            len_frames = end - start
+
+            self.send(job.id, 'Saving video:')
+            self.send(job.id, options['output_path'])
+
+            def on_frame(done):
+                self.send(job.id, f'Upscaling frame: {done} of {len_frames} ({round((done * 100) / len_frames)}%)')
+                summary = metrics.summary()
+                self.event(job, {'event': 'frame', 'frame': done, 'total': len_frames, 'elapsed': summary['elapsed'],
+                                 'fps': summary['fps'], 'megapixels_per_s': summary['megapixels_per_s']})
+
+            if upscale_video_cached(cache, filepath, start, end, options['output_path'], model_name, device, options,
+                                    process, on_frame, metrics, run_segments):
+                self.send(job.id, 'Loaded from cache')
+            elif reuse is not None:
+                self.send(job.id, f'Reused frames: {reuse.frames_reused}, re-inferred tiles: {reuse.tiles_inferred}')
+        else:
             for i, image in enumerate(images):
-                if i == 0:
-                    conn.send(f'Upscaling: {filepath.split("/")[-1]}')
-                
-                if video:
-                    conn.send(f'Upscaling frame: {i + 1} of {len_images} ({round(((i + 1) * 100) / len_images)}%)')
-
-                torch.cuda.empty_cache()
-
-                # Pil to cv2
-                img_L = np.array(image)
-                img_L = cv2.cvtColor(img_L, cv2.COLOR_RGB2BGR)
-                input_img = img_L.copy()
-                img_L = uint2tensor4(img_L)
-
-                img_L = img_L.to(device)
-
-                # Model predict
-                img_E = model(img_L)
-                img_E = tensor2uint(img_E)
-
-                # Image is upscaled, need to resize
-                img_E = cv2.resize(img_E, (input_img.shape[1], input_img.shape[0]), interpolation=cv2.INTER_LINEAR)
-                
-                # cv2 to pil & output image as ImageTk
-                output = Image.fromarray(cv2.cvtColor(img_E, cv2.COLOR_BGR2RGB))
-
-                conn.send(output)
-            conn.send('done')
+                job.check()
+
+                with stage(metrics, 'ipc'):
+                    image = unpack_image(self.input_ring, image)
+                job.read = i + 1
+                output, hit = upscale_image_cached(cache, image, model_name, device, options, process, metrics)
+
+                if hit:
+                    self.send(job.id, 'Loaded from cache')
+                with stage(metrics, 'ipc'):
+                    self.send(job.id, pack_image(self.output_ring, output))
+
@@ -0,0 +1,371 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from PIL import Image
+
+from models.network_rrdbnet import RRDBNet, fold_residual_scaling
+from metrics import Metrics, resource, stage
+from utils import uint2tensor4, tensor2uint, psnr
+from config import PRECISIONS, ENGINES, MIN_PSNR
+
+
+# Results of a case that can regress, and whether higher is better
+COMPARED = {'p50_ms': False, 'p90_ms': False, 'fps': True, 'peak_rss_mb': False}
+
+# Largest difference allowed between the dense blocks and the torch.cat reference, fp32 outputs in [0, 1]
+DENSE_TOLERANCE = 1e-4
+
+
+def parse_size(text: str) -> tuple:
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+def random_frames(count: int, size: tuple, seed: int) -> list:
+    # Smooth gradients plus noise, closer to real footage than pure noise for the encoder
+    rng = np.random.default_rng(seed)
+    w, h = size
+    base = np.stack([*np.meshgrid(np.linspace(0, 255, w), np.linspace(0, 255, h)), np.full((h, w), 128.)], axis=2)
+    frames = []
+    for i in range(count):
+        noise = rng.normal(0, 12, (h, w, 3))
+        frames.append(Image.fromarray(np.clip(np.roll(base, i * 4, axis=1) + noise, 0, 255).astype(np.uint8)))
+    return frames
+
+
+def build_model(sf: int, blocks: int, device, seed: int, dense: bool = True):
+    # Random weights, the timings do not depend on the checkpoint
+    torch.manual_seed(seed)
+    model = RRDBNet(in_nc=3, out_nc=3, nf=64, nb=blocks, gc=32, sf=sf).eval()
+    if dense:
+        model.enable_dense_execution()  # As load_model runs it, folding in place as the weights are not mapped
+    model.name = f'random_nb{blocks}_x{sf}'
+    model.weights = f'seed{seed}'
+    return model.to(device)
+
+
+def dense_error(images, sf: int, blocks: int, device, seed: int) -> float:
+    # Max abs difference of the dense blocks, folded in place or through fold_residual_scaling as load_model
+    # loads them, against the torch.cat reference on the same fp32 batch
+    img = torch.from_numpy(np.stack([np.asarray(image) for image in images])).permute(0, 3, 1, 2).float().div(255.)
+    img = img.to(device)
+
+    reference = build_model(sf, blocks, device, seed, dense=False)
+    folded = RRDBNet(in_nc=3, out_nc=3, nf=64, nb=blocks, gc=32, sf=sf).eval()
+    folded.load_state_dict(fold_residual_scaling(reference.state_dict()))
+    folded.enable_dense_execution(folded=True)
+    unfolded = build_model(sf, blocks, device, seed, dense=True)
+
+    with torch.no_grad():
+        expected = reference(img)
+        return max(float((model.to(device)(img) - expected).abs().max()) for model in (folded, unfolded))
+
+
+def case_key(case: dict) -> str:
+    return '|'.join(f'{name}={case[name]}' for name in sorted(case))
+
+
+def summarize(latencies: list, frames_per_call: int, pixels_per_call: int) -> dict:
+    latencies = np.array(latencies)
+    total = latencies.sum()
+    return {
+        'calls': len(latencies),
+        'mean_ms': 1000 * float(latencies.mean()),
+        'p50_ms': 1000 * float(np.percentile(latencies, 50)),
+        'p90_ms': 1000 * float(np.percentile(latencies, 90)),
+        'p99_ms': 1000 * float(np.percentile(latencies, 99)),
+        'fps': float(frames_per_call * len(latencies) / total),
+        'megapixels_per_s': float(pixels_per_call * len(latencies) / total / 1e6),
+    }
+
+
+def legacy_batch(model, images, sf, device, options, metrics=None):
+    # The per-image uint2tensor4 -> model -> tensor2uint path, for comparison with upscale_batch
+    from ai import autocast, tiled_forward
+
+    outputs = []
+    for image in images:
+        with stage(metrics, 'h2d', device=True):
+            img_L = uint2tensor4(np.asarray(image)[..., ::-1]).to(device)
+        with stage(metrics, 'forward', device=True), autocast(device, options['precision']):
+            img_E = tiled_forward(model, img_L, sf, options['tile'], options['tile_overlap'])
+        with stage(metrics, 'd2h', device=True):
+            outputs.append(tensor2uint(img_E)[..., ::-1])
+    return outputs
+
+
+def bench_inference(case: dict, args) -> dict:
+    # uint8 frames -> device tensor -> model -> uint8 frames, as upscale_batch runs them in the app
+    from ai import upscale_batch, resolve_precision
+
+    device = args.device
+    model = build_model(case['sf'], args.blocks, device, args.seed, case['blocks'] == 'dense')
+    images = random_frames(case['batch'], case['size'], args.seed)
+    options = {'tile': case['tile'], 'tile_overlap': args.tile_overlap, 'batch_size': case['batch'],
+               'precision': case['precision'], 'engine': case['engine']}
+    upscale = legacy_batch if case['path'] == 'legacy' else upscale_batch
+
+    latencies = []
+    metrics = Metrics(device)
+    with torch.no_grad():
+        for i in range(args.warmup + args.iterations):
+            start = time.perf_counter()
+            upscale(model, images, case['sf'], device, options, metrics if i >= args.warmup else None)
+            if device.startswith('cuda'):
+                torch.cuda.synchronize()
+            if i >= args.warmup:
+                latencies.append(time.perf_counter() - start)
+
+    w, h = case['size']
+    result = summarize(latencies, case['batch'], case['batch'] * w * h * case['sf'] ** 2)
+    result['stages'] = {name: timing['mean_ms'] for name, timing in metrics.summary()['stages'].items()}
+
+    # Reduced precision outputs against the same frames in fp32, checked against MIN_PSNR by main
+    if resolve_precision(device, case['precision']) != 'fp32':
+        with torch.no_grad():
+            outputs = upscale(model, images, case['sf'], device, options)
+            references = upscale(model, images, case['sf'], device, dict(options, precision='fp32'))
+        result['psnr_min'] = min(psnr(np.asarray(reference), np.asarray(output))
+                                 for reference, output in zip(references, outputs))
+    return result
+
+
+def bench_video(case: dict, args) -> dict:
+    # Decode and encode only, frames go through unchanged
+    from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+    from video_pipeline import stream_video
+
+    folder = tempfile.mkdtemp()
+    source = os.path.join(folder, 'source.mp4')
+    writer = FFMPEG_VideoWriter(source, case['size'], 30, codec='libx264')
+    for frame in random_frames(args.frames, case['size'], args.seed):
+        writer.write_frame(np.asarray(frame))
+    writer.close()
+
+    times = [time.perf_counter()]
+    metrics = Metrics()
+    stream_video(source, 0, args.frames, os.path.join(folder, 'output.mp4'), lambda frames: frames,
+                 on_frame=lambda _: times.append(time.perf_counter()), metrics=metrics)
+    elapsed = time.perf_counter() - times[0]
+
+    # Latencies between frames, throughput over the whole job including the final concat
+    w, h = case['size']
+    result = summarize(np.diff(times), 1, w * h)
+    result['fps'] = args.frames / elapsed
+    result['megapixels_per_s'] = args.frames * w * h / elapsed / 1e6
+    result['stages'] = {name: timing['mean_ms'] for name, timing in metrics.summary()['stages'].items()}
+
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+    return result
+
+
+def run_case(case: dict, args) -> dict:
+    # Runs in a fresh process, so peak RSS and thread settings belong to this case only
+    torch.set_num_threads(case['threads'])
+    torch.backends.cudnn.benchmark = False
+
+    result = bench_video(case, args) if case['kind'] == 'video' else bench_inference(case, args)
+    if resource is not None:
+        result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+    # The dense blocks against the torch.cat reference, after the peak RSS as it builds more models.
+    # Checked against DENSE_TOLERANCE by main, compiled engines trace the torch.cat blocks
+    if case['kind'] == 'inference' and case['blocks'] == 'dense' and case['engine'] == 'eager':
+        images = random_frames(case['batch'], case['size'], args.seed)
+        result['dense_max_abs_diff'] = dense_error(images, case['sf'], args.blocks, args.device, args.seed)
+    return result
+
+
+def _run_case(task):
+    case, args = task
+    try:
+        return case, run_case(case, args), None
+    except Exception as e:
+        return case, None, f'{type(e).__name__}: {e}'
+
+
+def sweep(args) -> list:
+    cases = []
+    threads = args.threads or [torch.get_num_threads()]
+
+    for path, size, sf, batch, tile, thread_count, precision, engine, blocks in itertools.product(
+            args.path, args.sizes, args.sf, args.batch, args.tile, threads, args.precision, args.engine, args.dense_blocks):
+        if path == 'legacy' and engine != 'eager':
+            continue
+        cases.append({'kind': 'inference', 'path': path, 'size': size, 'sf': sf, 'batch': batch, 'tile': tile,
+                      'threads': thread_count, 'precision': precision, 'engine': engine, 'blocks': blocks})
+
+    if args.frames:
+        for size, thread_count in itertools.product(args.sizes, threads):
+            cases.append({'kind': 'video', 'size': size, 'threads': thread_count})
+    return cases
+
+
+def environment(args) -> dict:
+    return {
+        'torch': torch.__version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'device': args.device,
+        'cuda': torch.cuda.get_device_name(args.device) if args.device.startswith('cuda') else None,
+        'blocks': args.blocks,
+    }
+
+
+def baseline_key(case: dict) -> str:
+    # Sizes come back from JSON as lists. Baselines recorded before --dense-blocks ran the blocks as load_model does
+    case = {name: tuple(value) if isinstance(value, list) else value for name, value in case.items()}
+    if case['kind'] == 'inference':
+        case.setdefault('blocks', 'dense')
+    return case_key(case)
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> tuple:
+    """
+    Regressions of more than tolerance (a fraction) against the baseline, for the cases both runs have,
+    the keys of the cases that are missing from the baseline and the number of cases compared.
+    """
+    previous = {baseline_key(entry['case']): entry['result'] for entry in baseline['results'] if entry['result'] is not None}
+    regressions, missing, compared = [], [], 0
+
+    for entry in results:
+        if entry['result'] is None:
+            continue
+        before = previous.get(entry['key'])
+        if before is None:
+            missing.append(entry['key'])
+            continue
+        compared += 1
+
+        for name, higher_is_better in COMPARED.items():
+            if name not in before or name not in entry['result']:
+                continue
+            old, new = before[name], entry['result'][name]
+            change = (old - new) / old if higher_is_better else (new - old) / old
+            if change > tolerance:
+                regressions.append((entry['key'], name, old, new))
+    return regressions, missing, compared
+
+
+def precision_failures(results: list) -> list:
+    # Cases whose reduced precision outputs fall below MIN_PSNR against fp32
+    return [(entry['key'], entry['result']['psnr_min'], MIN_PSNR[entry['case']['precision']])
+            for entry in results
+            if entry['result'] is not None and entry['result'].get('psnr_min', float('inf')) < MIN_PSNR.get(entry['case'].get('precision'), 0)]
+
+
+def dense_failures(results: list) -> list:
+    # Cases whose dense blocks differ from the torch.cat reference by more than DENSE_TOLERANCE
+    return [(entry['key'], entry['result']['dense_max_abs_diff']) for entry in results
+            if entry['result'] is not None and entry['result'].get('dense_max_abs_diff', 0.) > DENSE_TOLERANCE]
+
+
+def print_results(results: list) -> None:
+    print(f'{"case":<90} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"frames/s":>9} {"MP/s":>8} {"RSS MB":>8}')
+    for entry in results:
+        result = entry['result']
+        if result is None:
+            print(f'{entry["key"]:<90} failed: {entry["error"]}')
+            continue
+        print(f'{entry["key"]:<90} {result["p50_ms"]:>9.2f} {result["p90_ms"]:>9.2f} {result["p99_ms"]:>9.2f} '
+              f'{result["fps"]:>9.2f} {result["megapixels_per_s"]:>8.3f} {result.get("peak_rss_mb", 0):>8.0f}'
+              + (f' {result["psnr_min"]:>6.2f} dB' if 'psnr_min' in result else ''))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the inference core with a random-weight RRDBNet')
+    parser.add_argument('--path', nargs='+', default=['converter'], choices=('converter', 'legacy'),
+                        help='upscale_batch as the app runs it, or the older uint2tensor4/tensor2uint path')
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(128, 128), (256, 256)], help='input resolutions, WxH')
+    parser.add_argument('--sf', nargs='+', type=int, default=[2, 4], choices=(2, 4))
+    parser.add_argument('--batch', nargs='+', type=int, default=[1, 4], help='frames per forward pass')
+    parser.add_argument('--tile', nargs='+', type=int, default=[0, 128], help='tile sizes, 0 disables tiling')
+    parser.add_argument('--tile-overlap', type=int, default=16)
+    parser.add_argument('--threads', nargs='+', type=int, default=None, help='torch thread counts, the current one by default')
+    parser.add_argument('--precision', nargs='+', default=['fp32'], choices=PRECISIONS)
+    # int8 needs a calibrated checkpoint, see quantize.py
+    parser.add_argument('--engine', nargs='+', default=['eager'], choices=[e for e in ENGINES if e != 'int8'])
+    parser.add_argument('--device', default='cuda:0' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--blocks', type=int, default=23, help='RRDB blocks, 23 as in the model_zoo checkpoints')
+    parser.add_argument('--dense-blocks', nargs='+', default=['dense'], choices=('dense', 'concat'),
+                        help='dense blocks on a shared feature buffer as load_model runs them, or the torch.cat reference')
+    parser.add_argument('--frames', type=int, default=48, help='frames of the video decode/encode cases, 0 skips them')
+    parser.add_argument('-n', '--iterations', type=int, default=10)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the results as a baseline for later runs')
+    parser.add_argument('--baseline', metavar='FILE', help='compare against a saved baseline, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline, as a fraction')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    cases = sweep(args)
+
+    results = []
+    ctx = torch.multiprocessing.get_context('spawn')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for i, (case, result, error) in enumerate(pool.imap(_run_case, [(case, args) for case in cases])):
+            results.append({'key': case_key(case), 'case': case, 'result': result, 'error': error})
+            print(f'[{i + 1}/{len(cases)}] {results[-1]["key"]}', file=sys.stderr)
+
+    report = {'environment': environment(args), 'results': results}
+    print_results(results)
+    status = 0
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+
+    failures = precision_failures(results)
+    for key, value, minimum in failures:
+        print(f'Precision: {key} {value:.2f} dB against fp32, below {minimum:.0f} dB')
+    if failures:
+        status = 1
+
+    failures = dense_failures(results)
+    for key, value in failures:
+        print(f'Dense blocks: {key} differ from torch.cat by {value:.2e}, above {DENSE_TOLERANCE:.0e}')
+    if failures:
+        status = 1
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline['environment'] != report['environment']:
+            print('Warning: the baseline was recorded in a different environment', file=sys.stderr)
+
+        regressions, missing, compared = compare(results, baseline, args.tolerance)
+        for key in missing:
+            print(f'Not in the baseline: {key}')
+        for key, name, old, new in regressions:
+            print(f'Regression: {key} {name} {old:.2f} -> {new:.2f}')
+        if regressions:
+            return 1
+        if not compared:
+            print(f'No case of this run is in {args.baseline}, nothing was compared')
+            return 1
+        print(f'No regressions against {args.baseline} in {compared} cases (tolerance {args.tolerance:.0%})')
+
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
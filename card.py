@@ -1,6 +1,4 @@
 import tkinter as tk
-import cv2
-import numpy as np
 
 from config import SECONDARY_BG, IMAGE_EXTENSIONS, VIDEO_EXTENSIONS
 
@@ -8,89 +6,126 @@ from tkinter import ttk
 from PIL import Image, ImageTk
 
 
-MAX_THUMBNAIL_SIZE = 75
-
-
-class Card(tk.Frame):
-    def __init__(self, parent: tk.Frame, filepath: str, index: int, *args, **kwargs) -> None:
-        tk.Frame.__init__(self, parent, *args, **kwargs)
-        self.parent = parent
-        self.config(background=SECONDARY_BG, padx=3, pady=3, cursor='hand2')
+class Card:
+    """
+    A file opened in the footer. Nothing is read on creation: the footer decodes the thumbnail in the
+    background, and the full resolution image (or video capture) is loaded while the card is selected.
+    """
+    def __init__(self, filepath: str, index: int) -> None:
         self.selected = False
         self.index = index  # Position in footer
 
-        # Read and load image/video
         self.image = {}
         self.image['path'] = filepath  # str
-        self.image['output'] = None  # PhotoImage (PIL)
+        self.image['output'] = None  # Image (PIL)
+        self.image['file'] = None  # Image (PIL), while loaded
 
         extension = filepath.split('.')[-1]
 
         if extension in IMAGE_EXTENSIONS:
             self.is_image = True
-            self.image['file'] = Image.open(filepath)  # Image (PIL)
-            self.image['photoImage'] = ImageTk.PhotoImage(self.image['file'])  # PhotoImage (PIL)
-
         elif extension in VIDEO_EXTENSIONS:
             self.is_image = False
-            self.video_cap = cv2.VideoCapture(filepath)
-            self.frames_length = self.video_cap.get(cv2.CAP_PROP_FRAME_COUNT)
-            self.fps = self.video_cap.get(cv2.CAP_PROP_FPS)
-            self.select_video_frame(0)
+            self.frames = None  # VideoFrameService, while loaded
+            self.frames_length = None
+            self.fps = None
+            self.frame_index = None  # Frame wanted in image['file']
         else:
             raise ValueError # Handle this later
 
-        self.thumbnail_image = self._create_thumbnail_image()
+    @property
+    def name(self) -> str:
+        return self.image['path'].split('/')[-1]
+
+    @property
+    def loaded(self) -> bool:
+        return self.image['file'] is not None
+
+    def load(self) -> None:
+        # Read the full resolution image, or open the video on its first frame
+        if self.loaded:
+            return
+
+        if self.is_image:
+            self.image['file'] = Image.open(self.image['path'])  # Image (PIL)
+        else:
+            from frame_service import VideoFrameService  # cv2 is only loaded once a video is opened
+
+            self.frames = VideoFrameService(self.image['path'])
+            self.frames_length = self.frames.frames_length
+            self.fps = self.frames.fps
+            self.select_video_frame(0, wait=True)
+
+    def unload(self) -> None:
+        # Free the full resolution data, the output is kept
+        self.image['file'] = None
+
+        if not self.is_image and self.frames is not None:
+            self.frames.close()
+            self.frames = None
+
+    def select_video_frame(self, pointer: int, wait: bool = False):
+        # Shows the frame before pointer, returns None when it is still being decoded (see poll_video_frame)
+        self.frame_index = max(pointer - 1, 0)
+
+        if wait:
+            image = self.frames.read(self.frame_index)
+        else:
+            image = self.frames.get(self.frame_index)
+            if image is None:
+                self.frames.request(self.frame_index)
+
+        if image is not None:
+            self.image['file'] = image
+            return self.image
+
+    def poll_video_frame(self) -> bool:
+        # True once the frame asked for last is decoded and shown
+        image = self.frames.get(self.frame_index) if self.frames is not None else None
+        if image is None:
+            return False
+        self.image['file'] = image
+        return True
+
+
+class CardView(tk.Frame):
+    # Widget showing one card in the footer, reused for other cards as the footer scrolls
+    def __init__(self, parent: tk.Widget, *args, **kwargs) -> None:
+        tk.Frame.__init__(self, parent, *args, **kwargs)
+        self.parent = parent
+        self.config(background=SECONDARY_BG, padx=3, pady=3, cursor='hand2')
+        self.card = None
+        self.thumbnail_image = None
+        self.shown = None  # What the labels show, to skip redundant updates while scrolling
 
         # Image Label
-        self.lbl_img = ttk.Label(self, image=self.thumbnail_image)
+        self.lbl_img = ttk.Label(self)
         self.lbl_img.pack(side=tk.LEFT)
 
-        # Make image resolution label
-        w, h = self.image['file'].size
-        self.lbl_info = ttk.Label(self, text=f'{self.image["path"].split("/")[-1]}\n{w}x{h}', background=SECONDARY_BG)
+        # Name and resolution label
+        self.lbl_info = ttk.Label(self, background=SECONDARY_BG)
         self.lbl_info.pack(side=tk.LEFT)
 
-        # Bind to click event
+        # Clicks on the labels go to the frame
         for child in self.winfo_children():
             # WidgetName eg tk::Label
             child.bindtags((child, child.widgetName.split(':')[-1], self, '.', 'all'))
-    
-    def select_video_frame(self, pointer: int):
-        self.video_cap.set(cv2.CAP_PROP_POS_FRAMES, pointer - 1)
-        res, frame = self.video_cap.read()
-
-        if res:
-            self.image['file'] = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            self.image['photoImage'] = ImageTk.PhotoImage(self.image['file'])
-            return self.image
-    
-    def select_subclip(self, start: int, end: int) -> list:
-        self.video_cap.set(cv2.CAP_PROP_POS_FRAMES, start - 1)
-
-        clip = []
-        for _ in range(start, end):
-            res, frame = self.video_cap.read()
-
-            if res:
-                image = {}
-                image['file'] = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-                image['photoImage'] = ImageTk.PhotoImage(image['file'])
-                clip.append(image)
-
-        return clip
-    
-    def _create_thumbnail_image(self) -> ImageTk.PhotoImage:
-        ratio = self.image['file'].size[0] / self.image['file'].size[1]
-        new_size = MAX_THUMBNAIL_SIZE, round(MAX_THUMBNAIL_SIZE / ratio)
-
-        if new_size[1] > MAX_THUMBNAIL_SIZE:
-            new_size = round(MAX_THUMBNAIL_SIZE * ratio), MAX_THUMBNAIL_SIZE
-
-        thumbnail = self.image['file'].resize(new_size)
-        return ImageTk.PhotoImage(thumbnail)
-
-    def toggle_border(self) -> None:
-        color = 'white' if not self.selected else SECONDARY_BG
-        self.selected = not self.selected
+
+    def show(self, card: Card, thumbnail) -> None:
+        # thumbnail is the (image, (w, h)) pair of the ThumbnailLoader, None while decoding
+        self.card = card
+        shown = (card, thumbnail is not None, card.selected)
+        if shown == self.shown:
+            return
+        self.shown = shown
+
+        image, size = thumbnail if thumbnail is not None else (None, None)
+
+        self.thumbnail_image = ImageTk.PhotoImage(image) if image is not None else None
+        self.lbl_img.config(image=self.thumbnail_image if self.thumbnail_image is not None else '')
+
+        resolution = f'{size[0]}x{size[1]}' if size is not None else ''
+        self.lbl_info.config(text=f'{card.name}\n{resolution}')
+
+        color = 'white' if card.selected else SECONDARY_BG
         self.config(highlightbackground=color, highlightthickness=1)
@@ -0,0 +1,201 @@
+import argparse
+import glob
+import os
+import sys
+
+from collections import defaultdict
+
+import torch
+import cv2
+
+from PIL import Image
+
+from ai import load_model, model_scale, upscale_frames, upscale_image_cached, upscale_video_cached
+from result_cache import ResultCache
+from worker_pool import resolve_devices, pin_worker
+from temporal import TemporalReuse
+from metrics import Metrics, MetricsLog, stage
+from config import DEFAULT_OUTPUT_FOLDER, IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, MODELS, TILE_SIZE, TILE_OVERLAP, BATCH_SIZE, PRECISIONS, ENGINES, REUSE_THRESHOLD, RESULT_CACHE, METRICS_FILE
+
+
+# Per worker state, set by _init_worker
+_worker = {}
+
+
+def extension(filepath: str) -> str:
+    return filepath.split('.')[-1].lower()
+
+
+def collect_files(inputs: list, recursive: bool = False) -> list:
+    # Expand files, directories and glob patterns into a sorted list of supported files
+    supported = (*IMAGE_EXTENSIONS, *VIDEO_EXTENSIONS)
+    files = set()
+
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '**', '*') if recursive else os.path.join(pattern, '*')
+
+        for filepath in glob.glob(pattern, recursive=recursive):
+            if os.path.isfile(filepath) and extension(filepath) in supported:
+                files.add(os.path.normpath(filepath))
+
+    return sorted(files)
+
+
+def output_path(filepath: str, output_folder: str, output_format: str) -> str:
+    # Same naming as MainApplication.save_image
+    file_name = os.path.splitext(os.path.basename(filepath))[0] + '_upscaled_'
+    output_format = 'mp4' if extension(filepath) in VIDEO_EXTENSIONS else output_format
+    return os.path.join(output_folder, f'{file_name}.{output_format}')
+
+
+def _init_worker(model_name, placements, counter, threads, options, use_cache, metrics_file):
+    # Each worker takes the next placement. A failing initializer would make Pool respawn the worker forever,
+    # so errors are kept and reported by _upscale_file
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    device, cores = placements[index % len(placements)]
+    _worker['error'] = None
+
+    try:
+        pin_worker(device, cores)
+        if threads:
+            torch.set_num_threads(threads)
+        cv2.setNumThreads(1)
+
+        _worker['model'] = load_model(model_name, device)
+    except Exception as e:
+        _worker['error'] = f'Worker setup on {device} failed: {type(e).__name__}: {e}'
+        return
+
+    _worker['model_name'] = model_name
+    _worker['cache'] = ResultCache() if use_cache else None
+    _worker['sf'] = model_scale(model_name)
+    _worker['device'] = device
+    _worker['options'] = options
+    _worker['metrics_log'] = MetricsLog(metrics_file) if metrics_file else None
+
+
+def _upscale_file(args):
+    # Returns (filepath, destination, error, fatal), fatal when the worker could not be set up
+    filepath, destination = args
+    if _worker['error'] is not None:
+        return filepath, destination, _worker['error'], True
+
+    model, sf, device, options = _worker['model'], _worker['sf'], _worker['device'], _worker['options']
+    model_name, cache = _worker['model_name'], _worker['cache']
+    metrics = Metrics(device)
+    error = None
+
+    try:
+        with torch.no_grad():
+            def process(frames):
+                return upscale_frames(model, frames, sf, device, options, metrics)
+
+            if extension(filepath) in VIDEO_EXTENSIONS:
+                video_cap = cv2.VideoCapture(filepath)
+                frames_length = int(video_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+                video_cap.release()
+
+                if options['reuse_threshold'] is not None:
+                    process = TemporalReuse(process, options['reuse_threshold']).map
+
+                upscale_video_cached(cache, filepath, 0, frames_length, destination, model_name, device, options, process,
+                                     metrics=metrics)
+            else:
+                with stage(metrics, 'decode'):
+                    image = Image.open(filepath).convert('RGB')
+                output, _ = upscale_image_cached(cache, image, model_name, device, options, process, metrics)
+                with stage(metrics, 'encode'):
+                    output.save(destination)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+
+    if _worker['metrics_log'] is not None:
+        _worker['metrics_log'].write({'event': 'job', 'status': 'failed' if error else 'done', 'model': model_name,
+                                      'path': filepath, 'device': device, **metrics.summary()})
+    metrics.close()
+    return filepath, destination, error, False
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Ceibo Upscaling Lab, headless batch mode')
+    parser.add_argument('inputs', nargs='+', help='image/video files, directories or glob patterns')
+    parser.add_argument('-m', '--model', default='BSRGAN', choices=MODELS)
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT_FOLDER, help='output folder')
+    parser.add_argument('-f', '--format', default='png', choices=IMAGE_EXTENSIONS, help='output format for images')
+    parser.add_argument('-r', '--recursive', action='store_true', help='search directories recursively')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='number of worker processes, one per device by default')
+    parser.add_argument('-t', '--threads', type=int, default=None, help='torch threads per worker, the size of its core set by default')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='"cuda", a list like "cuda:0,cuda:1", or "cpu:N" for N workers on disjoint core sets')
+    parser.add_argument('--tile', type=int, default=TILE_SIZE, help='tile size in input pixels, 0 disables tiling')
+    parser.add_argument('--tile-overlap', type=int, default=TILE_OVERLAP)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='frames per forward pass, 0 for auto')
+    parser.add_argument('--precision', default=PRECISIONS[0], choices=PRECISIONS)
+    parser.add_argument('--engine', default=ENGINES[0], choices=ENGINES)
+    parser.add_argument('--reuse-threshold', type=int, default=REUSE_THRESHOLD,
+                        help='videos only: re-infer only tiles that changed by more than this (0-255) since the last inference')
+    parser.add_argument('--no-cache', action='store_true', default=not RESULT_CACHE, help='do not read or write the result cache')
+    parser.add_argument('--overwrite', action='store_true', help='upscale files whose output already exists')
+    parser.add_argument('--metrics', metavar='FILE', default=METRICS_FILE, help='append per file timings to this JSON lines file')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    files = collect_files(args.inputs, args.recursive)
+    if not files:
+        print('No supported files found', file=sys.stderr)
+        return 1
+
+    os.makedirs(args.output, exist_ok=True)
+
+    jobs = [(filepath, output_path(filepath, args.output, args.format)) for filepath in files]
+
+    # Outputs are named after the file name only, inputs that share it would overwrite each other
+    sources = defaultdict(list)
+    for filepath, destination in jobs:
+        sources[destination].append(filepath)
+    conflicts = {destination: paths for destination, paths in sources.items() if len(paths) > 1}
+    if conflicts:
+        for destination, paths in sorted(conflicts.items()):
+            print(f'{destination} would be written by {", ".join(paths)}', file=sys.stderr)
+        return 1
+
+    if not args.overwrite:
+        jobs = [job for job in jobs if not os.path.exists(job[1])]
+
+    options = {
+        'tile': args.tile,
+        'tile_overlap': args.tile_overlap,
+        'batch_size': args.batch_size,
+        'precision': args.precision,
+        'engine': args.engine,
+        'reuse_threshold': args.reuse_threshold,
+    }
+
+    placements = resolve_devices(args.device, args.workers)
+
+    failed = 0
+    ctx = torch.multiprocessing.get_context('spawn')
+    counter = ctx.Value('i', 0)
+    initargs = (args.model, placements, counter, args.threads, options, not args.no_cache, args.metrics)
+    with ctx.Pool(len(placements), initializer=_init_worker, initargs=initargs) as pool:
+        for i, (filepath, destination, error, fatal) in enumerate(pool.imap_unordered(_upscale_file, jobs)):
+            if fatal:
+                print(error, file=sys.stderr)
+                return 1  # Leaving the with block terminates the other workers
+            if error is None:
+                print(f'[{i + 1}/{len(jobs)}] {filepath} -> {destination}')
+            else:
+                failed += 1
+                print(f'[{i + 1}/{len(jobs)}] {filepath} failed: {error}', file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,5 +3,98 @@ PRIMARY_BG = '#343434'
 
 DEFAULT_OUTPUT_FOLDER = './outputs'
 
+MODELS = ('BSRGAN', 'BSRGANx2', 'ESRGAN', 'FSSR_JPEG', 'RealSR_DPED', 'RealSR_JPEG', 'RRDB')
+
 IMAGE_EXTENSIONS = ('jpg', 'png', 'gif')
-VIDEO_EXTENSIONS = ('mp4',)
\ No newline at end of file
+VIDEO_EXTENSIONS = ('mp4',)
+
+# Footer: only the visible cards get widgets, thumbnails are decoded by THUMBNAIL_WORKERS threads
+CARD_WIDTH = 400
+CARD_HEIGHT = 85
+FOOTER_ROWS = 2  # Rows shown before the footer scrolls
+THUMBNAIL_SIZE = 75
+THUMBNAIL_WORKERS = 4
+THUMBNAIL_CACHE = 2048  # Decoded thumbnails kept in memory
+
+# Work area: images are shown from a pyramid of halved copies, resizes wait for RESIZE_DELAY ms without events
+PYRAMID_MIN_SIZE = 256  # Smallest level, longest side in pixels
+PYRAMID_CACHE = 4  # Images whose pyramid is kept, original and output of the last cards
+RESIZE_DELAY = 80
+
+# Region previews: the crop sent to the upscaling process gets PREVIEW_MARGIN pixels of context on every side
+PREVIEW_MARGIN = 32
+PREVIEW_MIN_SIZE = 8  # Smaller selections (in image pixels) are ignored
+
+# Video scrubbing: decoded frames kept per open video, and frames decoded around the slider position
+FRAME_CACHE_BYTES = 512 * 1024 ** 2
+PREFETCH_AHEAD = 30
+PREFETCH_BEHIND = 5
+FRAME_POLL = 15  # ms between checks for a frame that is being decoded
+
+# Tiled inference, sizes in input pixels (TILE_SIZE = 0 disables tiling)
+TILE_SIZE = 256
+TILE_OVERLAP = 16
+
+# Frames stacked per forward pass for videos (0 sizes batches from BATCH_PIXEL_BUDGET)
+BATCH_SIZE = 0
+BATCH_PIXEL_BUDGET = 512 * 512
+BATCH_OUTPUT_BYTES = 512 * 1024 ** 2  # Host memory of the float32 tile accumulators of a tiled batch
+
+# Frames buffered between the decode, inference and encode stages of a video job
+PIPELINE_QUEUE_SIZE = 8
+
+# Video jobs are encoded in chunks of CHUNK_FRAMES frames, committed to JOBS_FOLDER so they can resume
+CHUNK_FRAMES = 240
+JOBS_FOLDER = './jobs'
+
+# With several inference workers, video jobs are split at keyframes into segments of at least
+# SEGMENT_MIN_FRAMES frames, each decoded, upscaled and encoded by one worker
+SEGMENT_MIN_FRAMES = 48
+
+# Memory budget for the models kept loaded by the upscaling process
+MODEL_CACHE_BYTES = 512 * 1024 ** 2
+
+# Shared memory frame slots per direction between the UI and the upscaling process
+FRAME_SLOTS = 4
+FRAME_SLOT_BYTES = 3840 * 2160 * 3
+
+# Parallel inference workers, CPU workers are pinned to disjoint core sets
+ALL_DEVICES = 'All devices'  # GPU selector entry that runs one worker per CUDA device
+CPU_WORKERS = 1
+POOL_CHUNK_SIZE = 4
+
+# Inference precision: fp32 is the reference, fp16 autocast runs on CUDA and bf16 on CPUs/GPUs that support it.
+# Reduced precision outputs are expected to stay above MIN_PSNR dB against fp32 (see README)
+PRECISIONS = ('fp32', 'fp16', 'bf16')
+MIN_PSNR = {'fp16': 45., 'bf16': 38.}
+
+# Inference engines, compiled graphs are built per input shape bucket and cached in ENGINE_FOLDER
+ENGINES = ('eager', 'torchscript', 'compile', 'int8')
+ENGINE_FOLDER = './engines'
+ENGINE_BUCKET = 64
+
+# int8 models written by quantize.py next to the model_zoo checkpoints
+QUANTIZED_SUFFIX = '_int8.pt'
+
+# Memory-mapped copies of the model_zoo checkpoints, converted on first load (or with weights.py)
+MMAP_SUFFIX = '_mmap.pt'
+
+# Temporal reuse for videos: frames/tiles whose pixels differ by at most REUSE_THRESHOLD (0-255) from the
+# last inferred input reuse the previous output (None disables it)
+REUSE_THRESHOLD = None
+REUSE_TILE = 64
+REUSE_MARGIN = 16
+REUSE_MAX_CHANGED = 0.5
+
+# On-disk cache of upscaled results, shared by the UI and the CLI
+RESULT_CACHE = True
+RESULT_CACHE_FOLDER = './cache'
+RESULT_CACHE_BYTES = 4 * 1024 ** 3
+
+# Job priorities in the upscaling process, lower values run first and preempt videos between frames
+PRIORITY_PREVIEW = 0
+PRIORITY_IMAGE = 1
+PRIORITY_VIDEO = 2
+
+# JSON lines file the upscaling process appends its metric events to (None only sends them to the UI)
+METRICS_FILE = None
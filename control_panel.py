@@ -1,9 +1,8 @@
 import tkinter as tk
-import torch
 
 from tkinter import ttk
 from PIL import ImageTk
-from config import SECONDARY_BG, PRIMARY_BG, DEFAULT_OUTPUT_FOLDER, IMAGE_EXTENSIONS
+from config import SECONDARY_BG, PRIMARY_BG, DEFAULT_OUTPUT_FOLDER, IMAGE_EXTENSIONS, MODELS, ALL_DEVICES, PRECISIONS, ENGINES
 
 
 LEFT_PADDING = 20
@@ -21,8 +20,7 @@ class ControlPanel(tk.Frame):
         self.lbl_selector = ttk.Label(self, text='AI Model:', background=SECONDARY_BG)
         self.lbl_selector.pack(side=tk.TOP, pady=(15, 0), padx=(LEFT_PADDING, 0), anchor='w')
 
-        models_list = ['BSRGAN', 'BSRGANx2', 'ESRGAN', 'FSSR_JPEG', 'RealSR_DPED', 'RealSR_JPEG', 'RRDB']
-        self.model_selector = ttk.Combobox(self, values=models_list, state='readonly', cursor='hand2')
+        self.model_selector = ttk.Combobox(self, values=MODELS, state='readonly', cursor='hand2')
         self.model_selector.current(0)  # Select first option
         self.model_selector.pack(side=tk.TOP, pady=5, padx=(LEFT_PADDING,), anchor='w')
 
@@ -30,13 +28,27 @@ class ControlPanel(tk.Frame):
         self.lbl_device = ttk.Label(self, text='GPU Device:', background=SECONDARY_BG)
         self.lbl_device.pack(side=tk.TOP, pady=(15, 0), padx=(LEFT_PADDING, 0), anchor='w')
 
-        devices = []
-        for i in range(torch.cuda.device_count()):
-            devices.append(torch.cuda.get_device_properties(i).name)
-        self.gpu_selector = ttk.Combobox(self, values=devices, state='readonly', cursor='hand2')
-        self.gpu_selector.current(0)  # Select first option
+        # Filled once the upscaling process reports its devices, see set_devices
+        self.gpu_selector = ttk.Combobox(self, state='disabled', cursor='hand2')
+        self.gpu_selector.set('Detecting devices...')
         self.gpu_selector.pack(side=tk.TOP, pady=5, padx=(LEFT_PADDING, 0), anchor='w')
 
+        # PRECISION
+        self.lbl_precision = ttk.Label(self, text='Precision:', background=SECONDARY_BG)
+        self.lbl_precision.pack(side=tk.TOP, pady=(15, 0), padx=(LEFT_PADDING, 0), anchor='w')
+
+        self.precision_selector = ttk.Combobox(self, values=PRECISIONS, state='readonly', cursor='hand2')
+        self.precision_selector.current(0)  # Select first option
+        self.precision_selector.pack(side=tk.TOP, pady=5, padx=(LEFT_PADDING,), anchor='w')
+
+        # ENGINE
+        self.lbl_engine = ttk.Label(self, text='Engine:', background=SECONDARY_BG)
+        self.lbl_engine.pack(side=tk.TOP, pady=(15, 0), padx=(LEFT_PADDING, 0), anchor='w')
+
+        self.engine_selector = ttk.Combobox(self, values=ENGINES, state='readonly', cursor='hand2')
+        self.engine_selector.current(0)  # Select first option
+        self.engine_selector.pack(side=tk.TOP, pady=5, padx=(LEFT_PADDING,), anchor='w')
+
         # OUTPUT FORMAT
         self.lbl_output_format = ttk.Label(self, text='Output format:', background=SECONDARY_BG)
         self.lbl_output_format.pack(side=tk.TOP, pady=(15, 0), padx=(LEFT_PADDING, 0), anchor='w')
@@ -99,6 +111,13 @@ class ControlPanel(tk.Frame):
         self.end_entry.delete(0, tk.END)
         self.end_entry.insert(0, end)
     
+    def set_devices(self, devices: list) -> None:
+        # CUDA device names, the upscaling process runs on the CPU when there are none
+        if len(devices) > 1:
+            devices = [*devices, ALL_DEVICES]
+        self.gpu_selector.config(values=devices or ['CPU'], state='readonly')
+        self.gpu_selector.current(0)  # Select first option
+
     def show_video_controls(self) -> None:
         self.separator.pack_forget()
         self.video_frm.pack(side=tk.BOTTOM)
@@ -118,6 +137,12 @@ class ControlPanel(tk.Frame):
     def on_gpu_change(self, fn):
         self.gpu_selector.bind('<<ComboboxSelected>>', lambda _, entry=self.gpu_selector: fn(entry))
 
+    def on_precision_change(self, fn):
+        self.precision_selector.bind('<<ComboboxSelected>>', lambda _, entry=self.precision_selector: fn(entry))
+
+    def on_engine_change(self, fn):
+        self.engine_selector.bind('<<ComboboxSelected>>', lambda _, entry=self.engine_selector: fn(entry))
+
     def on_output_format_change(self, fn):
         self.output_format_selector.bind('<Key>', lambda _, entry=self.output_format_selector: fn(entry))
 
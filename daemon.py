@@ -0,0 +1,12 @@
+import os
+
+
+def upscale_process(conn, input_ring_name=None, output_ring_name=None):
+    # Entry point of the upscaling process. torch and moviepy are imported here, in the process itself,
+    # so the UI that starts it never loads them
+    from ai import UpscaleDaemon
+
+    if not os.path.isdir('./outputs'):
+        os.mkdir('./outputs')
+
+    UpscaleDaemon(conn, input_ring_name, output_ring_name).run()
@@ -0,0 +1,117 @@
+import os
+import math
+
+import torch
+import torch.nn.functional as F
+
+from config import ENGINE_FOLDER, ENGINE_BUCKET, QUANTIZED_SUFFIX
+
+
+class CompiledModel:
+    """
+    Runs a model through a compiled backend instead of eager mode.
+
+    'torchscript' traces and freezes one graph per (device, precision, input shape bucket) and keeps it on
+    disk in ENGINE_FOLDER, 'compile' uses torch.compile with static shapes. Inputs are padded up to a
+    multiple of `bucket` pixels so a handful of graphs covers every resolution, the output is cropped back.
+    """
+    def __init__(self, model, device, backend: str, precision: str = 'fp32', bucket: int = ENGINE_BUCKET,
+                 folder: str = ENGINE_FOLDER) -> None:
+        self.model = model
+        self.device = torch.device(device)
+        self.backend = backend
+        self.precision = precision
+        self.bucket = bucket
+        self.folder = folder
+        self.graphs = {}  # input shape -> TorchScript module
+
+        if backend == 'compile':
+            self.compiled = torch.compile(model, dynamic=False)
+
+    def _path(self, shape) -> str:
+        # Graphs embed the weights, so the key includes which ones (see weights.weights_identity)
+        name = getattr(self.model, 'name', type(self.model).__name__)
+        if getattr(self.model, 'weights', None):
+            name = f'{name}_{self.model.weights}'
+        shape = 'x'.join(str(s) for s in shape)
+        version = torch.__version__.split('+')[0]
+        return os.path.join(self.folder, f'{name}_{self.device.type}_{self.precision}_{shape}_torch{version}.pt')
+
+    def _graph(self, x: torch.Tensor):
+        shape = tuple(x.shape)
+
+        if shape not in self.graphs:
+            path = self._path(shape)
+
+            if os.path.isfile(path):
+                graph = torch.jit.load(path, map_location=self.device)
+            else:
+                graph = torch.jit.freeze(torch.jit.trace(self.model.eval(), x, check_trace=False))
+                if self.device.type == 'cpu':
+                    graph = torch.jit.optimize_for_inference(graph)
+
+                os.makedirs(self.folder, exist_ok=True)
+                torch.jit.save(graph, path)
+
+            self.graphs[shape] = graph
+        return self.graphs[shape]
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        _, _, h, w = x.shape
+        pad_h = math.ceil(h / self.bucket) * self.bucket - h
+        pad_w = math.ceil(w / self.bucket) * self.bucket - w
+
+        if pad_h or pad_w:
+            x = F.pad(x, (0, pad_w, 0, pad_h), mode='replicate')
+
+        if self.backend == 'compile':
+            out = self.compiled(x)
+        else:
+            out = self._graph(x)(x)
+
+        sf = out.shape[2] // x.shape[2]
+        return out[:, :, :h * sf, :w * sf]
+
+
+def quantized_path(model_name: str) -> str:
+    return os.path.join('model_zoo', f'{model_name}{QUANTIZED_SUFFIX}')
+
+
+def quantized_identity(model_name: str) -> str:
+    # Changes whenever quantize.py rewrites the int8 model, as weights.weights_identity for the float weights
+    stat = os.stat(quantized_path(model_name))
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+
+def int8_available(model_name: str, device) -> bool:
+    # int8 models made by quantize.py only run on the CPU
+    return torch.device(device).type == 'cpu' and os.path.isfile(quantized_path(model_name))
+
+
+def get_engine(model, device, engine: str = 'eager', precision: str = 'fp32'):
+    """
+    Callable that runs model with the given engine, built once and kept on the model.
+    TorchScript graphs are traced in float32, so reduced precision runs eager under autocast instead.
+    'int8' loads the quantized model saved by quantize.py, it ignores precision.
+    """
+    if engine == 'eager' or (engine == 'torchscript' and precision != 'fp32'):
+        return model
+
+    if engine == 'int8':
+        precision = 'int8'
+        if not int8_available(model.name, device):
+            return model
+
+    if not hasattr(model, 'engines'):
+        model.engines = {}
+
+    key = (engine, str(device), precision, quantized_identity(model.name) if engine == 'int8' else None)
+    if key not in model.engines:
+        if engine == 'int8':
+            # A model quantized again replaces the one loaded before
+            for stale in [k for k in model.engines if k[0] == 'int8']:
+                del model.engines[stale]
+            model.engines[key] = torch.jit.load(quantized_path(model.name), map_location='cpu')
+        else:
+            model.engines[key] = CompiledModel(model, device, engine, precision)
+    return model.engines[key]
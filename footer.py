@@ -2,13 +2,18 @@ import math
 
 import tkinter as tk
 
-from card import Card
+from card import Card, CardView
+from thumbnails import ThumbnailLoader
 
 from tkinter import ttk
-from config import SECONDARY_BG
+from config import SECONDARY_BG, CARD_WIDTH, CARD_HEIGHT, FOOTER_ROWS
 
 
 class Footer(tk.Frame):
+    """
+    Scrollable grid of the opened files. Cards are plain data, widgets only exist for the visible
+    rows (plus one) and are moved and reused as the canvas scrolls.
+    """
     def __init__(self, parent, *args, **kwargs) -> None:
         tk.Frame.__init__(self, parent, *args, **kwargs)
         self.parent = parent
@@ -18,11 +23,22 @@ class Footer(tk.Frame):
         self.index_selected = None
         self.event_trigger = None
 
+        self.canvas = tk.Canvas(self, background=SECONDARY_BG, highlightthickness=0, height=0, yscrollincrement=CARD_HEIGHT)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.canvas.yview)
+        self.canvas.config(yscrollcommand=self.on_scroll)
+        self.canvas.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        self.canvas.bind('<Configure>', lambda _: self.update_grid())
+        self.bind_scroll(self.canvas)
+
+        self.views = []  # (CardView, canvas window id)
+        self.num_cols = 1
+        self.thumbnails = ThumbnailLoader(self, self.thumbnail_ready)
+
         self.pack(side=tk.BOTTOM, fill=tk.X)
 
     def is_card_loaded(self):
         return len(self.cards) > 0
-    
+
     def on_card_selected(self, fn):
         # Event triggered on every card click
         self.event_trigger = fn
@@ -31,50 +47,76 @@ class Footer(tk.Frame):
         if index is None:
             index = len(self.cards)
 
-        card = Card(self, filepath, index)
-        card.bind('<Button-1>', lambda _, c=card: self.event_trigger(c))
-        self.cards.append(card)
+        self.cards.insert(index, Card(filepath, index))
+        for i, card in enumerate(self.cards[index + 1:], start=index + 1):
+            card.index = i
 
     def select_card_by_index(self, index: int) -> Card:
         # Deselect selected card
         if len(self.cards) == 0:
             return
 
-        if self.index_selected is not None:
-            self.cards[self.index_selected].toggle_border()
+        if self.index_selected is not None and self.index_selected != index:
+            self.cards[self.index_selected].selected = False
+            self.cards[self.index_selected].unload()
 
-        # select new, update index and return selected thumbnail
-        self.cards[index].toggle_border()
+        # select new, update index and return selected card
+        card = self.cards[index]
+        card.selected = True
+        card.load()
         self.index_selected = index
-        return self.cards[index]
+
+        self.see(index)
+        self.render()
+        return card
 
     def on_footer_change(self, fn):
         self.bind('<Configure>', fn)
 
     def current_card_index(self) -> int:
         return self.index_selected
-    
+
     def update_card(self, card: Card, index: int) -> None:
         self.cards[index] = card
-    
+
     def get_current_card(self) -> Card:
         return self.cards[self.index_selected]
 
     def remove_card_by_index(self, index: int) -> None:
-        self.cards[index].grid_forget()
+        self.cards[index].unload()
         del self.cards[index]
 
         if index == self.index_selected:
             self.index_selected = None
-
-        if len(self.cards) == 0:
-            # Reset footer config to hide it
-            self.config(width=600, height=0, background=SECONDARY_BG, padx=10, pady=10)
-        else:
-            # Reassing indexes
-            for i, card in enumerate(self.cards):
-                card.index = i
-            self.update_grid()
+        elif self.index_selected is not None and index < self.index_selected:
+            self.index_selected -= 1
+
+        # Reassing indexes
+        for i, card in enumerate(self.cards[index:], start=index):
+            card.index = i
+        self.update_grid()
+
+    #########################################  GRID  #########################################
+    def bind_scroll(self, widget: tk.Widget) -> None:
+        widget.bind('<MouseWheel>', lambda e: self.canvas.yview_scroll(-1 if e.delta > 0 else 1, 'units'))
+        widget.bind('<Button-4>', lambda _: self.canvas.yview_scroll(-1, 'units'))
+        widget.bind('<Button-5>', lambda _: self.canvas.yview_scroll(1, 'units'))
+
+    def on_scroll(self, first, last) -> None:
+        self.scrollbar.set(first, last)
+        self.render()
+
+    def see(self, index: int) -> None:
+        # Scroll so the card's row is visible
+        rows = math.ceil(len(self.cards) / self.num_cols)
+        row = index // self.num_cols
+        top = self.canvas.canvasy(0)
+        height = self.canvas.winfo_height()
+
+        if row * CARD_HEIGHT < top:
+            self.canvas.yview_moveto(row / rows)
+        elif (row + 1) * CARD_HEIGHT > top + height:
+            self.canvas.yview_moveto(((row + 1) * CARD_HEIGHT - height) / (rows * CARD_HEIGHT))
 
     def update_grid(self):
         """
@@ -83,8 +125,52 @@ class Footer(tk.Frame):
          3 4 5
          6 7 8
         """
-        w = self.winfo_width()
-        num_cols = max(math.floor(w / 400), 1)
-        
-        for i, card in enumerate(self.cards):
-            card.grid(row=math.floor(i / num_cols), column=i % num_cols, sticky='w')
+        w = self.canvas.winfo_width()
+        self.num_cols = max(math.floor(w / CARD_WIDTH), 1)
+        rows = math.ceil(len(self.cards) / self.num_cols)
+
+        self.canvas.config(height=min(rows, FOOTER_ROWS) * CARD_HEIGHT, scrollregion=(0, 0, w, rows * CARD_HEIGHT))
+
+        if rows > FOOTER_ROWS:
+            self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        else:
+            self.scrollbar.pack_forget()
+
+        self.render()
+
+    def render(self) -> None:
+        # Point the views at the cards of the visible rows and park the rest
+        top = self.canvas.canvasy(0)
+        first_row = max(int(top // CARD_HEIGHT), 0)
+        last_row = int((top + max(self.canvas.winfo_height(), CARD_HEIGHT)) // CARD_HEIGHT)
+
+        start = first_row * self.num_cols
+        visible = self.cards[start:(last_row + 1) * self.num_cols]
+
+        while len(self.views) < len(visible):
+            view = CardView(self.canvas)
+            view.bind('<Button-1>', lambda _, v=view: self.event_trigger(v.card))
+            for widget in (view, *view.winfo_children()):
+                self.bind_scroll(widget)
+            self.views.append((view, self.canvas.create_window(0, 0, window=view, anchor='nw')))
+
+        for i, (view, window) in enumerate(self.views):
+            if i < len(visible):
+                card = visible[i]
+                index = start + i
+                x, y = (index % self.num_cols) * CARD_WIDTH, (index // self.num_cols) * CARD_HEIGHT
+                self.canvas.coords(window, x, y)
+                self.canvas.itemconfigure(window, state='normal')
+                view.show(card, self.thumbnails.get(card.image['path']))
+            else:
+                view.card = view.shown = None
+                self.canvas.itemconfigure(window, state='hidden')
+
+        # Decode the visible thumbnails first, then the next row
+        ahead = self.cards[start:(last_row + 2) * self.num_cols]
+        self.thumbnails.request([card.image['path'] for card in ahead])
+
+    def thumbnail_ready(self, path: str) -> None:
+        for view, _ in self.views:
+            if view.card is not None and view.card.image['path'] == path:
+                view.show(view.card, self.thumbnails.get(path))
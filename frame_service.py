@@ -0,0 +1,180 @@
+import bisect
+import re
+import subprocess
+import threading
+
+from collections import OrderedDict
+
+import cv2
+
+from PIL import Image
+
+from config import FRAME_CACHE_BYTES, PREFETCH_AHEAD, PREFETCH_BEHIND
+
+
+def keyframe_index(path: str, fps: float) -> list:
+    # Frame numbers of the keyframes, from the timestamps ffmpeg reports while decoding keyframes only
+    from moviepy.config import get_setting  # Locates ffmpeg, kept out of the UI until a video is opened
+
+    command = [get_setting('FFMPEG_BINARY'), '-hide_banner', '-nostats', '-skip_frame', 'nokey', '-i', path,
+               '-map', '0:v:0', '-vf', 'showinfo', '-f', 'null', '-']
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='replace')
+
+    # ffmpeg shifts timestamps by the start time of the file, not of the video stream, which can start later.
+    # Frame 0 is the first frame of the stream, its first keyframe
+    times = [float(t) for t in re.findall(r'\] n:\s*\d+ pts:\s*\S+ pts_time:(-?[\d.]+)', result.stderr)]
+    return sorted({round((t - min(times)) * fps) for t in times}) or [0]
+
+
+class VideoFrameService:
+    """
+    Decoded frames of a video for scrubbing.
+
+    A decoder thread owns the capture: it decodes the last requested frame first, then prefetches the
+    frames around it. Frames are kept in an LRU cache limited to cache_bytes. With the keyframe index
+    (built in the background when the service opens) a request jumps to the closest keyframe at or
+    before it, or keeps decoding forward when that is shorter, and the frames decoded on the way that fall
+    in the prefetch window are cached. The window is cut down to the frames cache_bytes can hold.
+    """
+    def __init__(self, path: str, cache_bytes: int = FRAME_CACHE_BYTES, ahead: int = PREFETCH_AHEAD,
+                 behind: int = PREFETCH_BEHIND) -> None:
+        self.path = path
+        self.video_cap = cv2.VideoCapture(path)
+        self.frames_length = int(self.video_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = self.video_cap.get(cv2.CAP_PROP_FPS)
+        self.cache_bytes = cache_bytes
+
+        # Prefetch no more than the cache holds, or the window would evict itself and never be complete
+        frame_bytes = max(int(self.video_cap.get(cv2.CAP_PROP_FRAME_WIDTH)) * int(self.video_cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) * 3, 1)
+        capacity = max(cache_bytes // frame_bytes, 1)
+        self.ahead = min(ahead, capacity - 1)
+        self.behind = min(behind, capacity - 1 - self.ahead)
+
+        self.cache = OrderedDict()  # frame number -> Image (PIL)
+        self.cached_bytes = 0
+        self.position = 0  # Frame number the capture reads next
+        self.keyframes = None
+        self.wanted = None
+        self.closed = False
+        self.condition = threading.Condition()
+
+        threading.Thread(target=self._index, daemon=True).start()
+        threading.Thread(target=self._work, daemon=True).start()
+
+    def _index(self) -> None:
+        try:
+            keyframes = keyframe_index(self.path, self.fps)
+        except (OSError, ValueError):
+            return  # Seeks fall back to the capture's own
+        with self.condition:
+            self.keyframes = keyframes
+
+    def get(self, index: int):
+        # Cached frame, None when it is not decoded yet
+        with self.condition:
+            if index in self.cache:
+                self.cache.move_to_end(index)
+                return self.cache[index]
+        return None
+
+    def request(self, index: int) -> None:
+        # Decode index next, replacing the previous request, and prefetch around it
+        with self.condition:
+            self.wanted = min(max(index, 0), self.frames_length - 1)
+            self.condition.notify()
+
+    def read(self, index: int, timeout: float = None):
+        # Blocking get
+        image = self.get(index)
+        if image is not None:
+            return image
+
+        self.request(index)
+        with self.condition:
+            self.condition.wait_for(lambda: index in self.cache or index >= self.frames_length or self.closed, timeout)
+            return self.cache.get(index)
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def _next(self):
+        # Frame to decode next: the request, then the prefetch window around it (ahead first)
+        if self.wanted is None:
+            return None
+
+        for offset in (*range(self.ahead + 1), *range(-1, -self.behind - 1, -1)):
+            index = self.wanted + offset
+            if 0 <= index < self.frames_length and index not in self.cache:
+                return index
+        return None
+
+    def _in_window(self, index: int) -> bool:
+        return self.wanted is not None and self.wanted - self.behind <= index <= self.wanted + self.ahead
+
+    def _store(self, index: int, image: Image.Image) -> None:
+        if index in self.cache or not self._in_window(index):
+            return
+        self.cache[index] = image
+        self.cached_bytes += image.width * image.height * len(image.getbands())
+
+        # Evict the frames outside the window first, then the least recently used, never the requested one
+        while self.cached_bytes > self.cache_bytes and len(self.cache) > 1:
+            old_index = next((i for i in self.cache if not self._in_window(i)), None)
+            if old_index is None:
+                old_index = next(i for i in self.cache if i != self.wanted)
+            old = self.cache.pop(old_index)
+            self.cached_bytes -= old.width * old.height * len(old.getbands())
+        self.condition.notify_all()
+
+    def _seek_target(self, index: int) -> int:
+        # Where to start decoding index from: the current position if it is on the way, else a keyframe
+        if self.keyframes is None:
+            return self.position if self.position <= index <= self.position + self.ahead else index
+
+        # Before the first indexed keyframe (bisect would wrap to the last one) decoding starts from the beginning
+        i = bisect.bisect_right(self.keyframes, index)
+        keyframe = self.keyframes[i - 1] if i > 0 else 0
+        if keyframe <= self.position <= index:
+            return self.position
+        return keyframe
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                while not self.closed and self._next() is None:
+                    self.condition.wait()
+                if self.closed:
+                    break
+                index = self._next()
+                start = self._seek_target(index)
+
+            if start != self.position:
+                self.video_cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+                self.position = start
+
+            # Decode up to index, keeping the frames on the way that are in the window
+            while self.position <= index:
+                with self.condition:
+                    keep = self._in_window(self.position)
+
+                res, frame = self.video_cap.read() if keep else (self.video_cap.grab(), None)
+                if not res:
+                    with self.condition:
+                        self.frames_length = min(self.frames_length, self.position)
+                        self.condition.notify_all()
+                    break
+
+                if keep:
+                    image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+                    with self.condition:
+                        self._store(self.position, image)
+                self.position += 1
+
+                # A new request stops this decode
+                with self.condition:
+                    if self._next() != index:
+                        break
+
+        self.video_cap.release()
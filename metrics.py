@@ -0,0 +1,153 @@
+import contextlib
+import json
+import threading
+import time
+
+from collections import defaultdict
+
+import torch
+
+try:
+    import resource  # Peak RSS, not available on Windows
+except ImportError:
+    resource = None
+
+
+# Stages in pipeline order, as reported by Metrics.summary
+STAGES = ('cache', 'decode', 'ipc', 'convert', 'h2d', 'forward', 'd2h', 'resize', 'encode', 'mux')
+
+
+def max_rss_mb():
+    # Peak RSS of the process so far, None where resource is not available
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+
+
+def stage(metrics, name: str, device: bool = False):
+    # Times a block into metrics, does nothing without one. device marks blocks that launch device work
+    if metrics is None:
+        return contextlib.nullcontext()
+    return metrics.stage(name, device)
+
+
+class Metrics:
+    """
+    Wall time per pipeline stage, frame and pixel counts of one job.
+
+    Stages run in several threads (decoder, inference, encoder) and inference workers report theirs
+    through merge, so times are summed per stage and can add up to more than the job's elapsed time.
+    On CUDA the device is synchronized at the end of the blocks timed with device=True, so asynchronous
+    copies and kernels are charged to the stage that launched them. Host stages (decode, encode...) run
+    in their own threads and never wait for the device.
+
+    Peak memory is per job where the process counters allow it: the device peak is reset when a job starts
+    while no other job of the process is running on that device (a preview run in the middle of a video
+    counts towards the video), and the host peak is only known when the job raised the process peak.
+    Call close when the job ends.
+    """
+    running = defaultdict(int)  # Open Metrics per CUDA device of this process
+    running_lock = threading.Lock()
+
+    def __init__(self, device=None) -> None:
+        self.device = torch.device(device) if device is not None else None
+        self.sync = self.device is not None and self.device.type == 'cuda' and torch.cuda.is_available()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.frames = 0
+        self.pixels = 0  # Output pixels
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.rss_before = max_rss_mb()
+        self.memory = None  # Peak memory once closed
+
+        if self.sync:
+            with Metrics.running_lock:
+                if not Metrics.running[self.device]:
+                    torch.cuda.reset_peak_memory_stats(self.device)
+                Metrics.running[self.device] += 1
+
+    def close(self) -> None:
+        # Ends the job, its peak memory stops following the process counters
+        if self.memory is not None:
+            return
+        self.memory = self.peak_memory()
+        if self.sync:
+            with Metrics.running_lock:
+                Metrics.running[self.device] -= 1
+
+    @contextlib.contextmanager
+    def stage(self, name: str, device: bool = False):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if device and self.sync:
+                torch.cuda.synchronize(self.device)
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float, calls: int = 1) -> None:
+        with self.lock:
+            self.seconds[name] += seconds
+            self.calls[name] += calls
+
+    def count(self, frames: int, pixels: int) -> None:
+        with self.lock:
+            self.frames += frames
+            self.pixels += pixels
+
+    def stages(self) -> dict:
+        # Plain dict of the stage totals, what inference workers send back
+        with self.lock:
+            return {name: (self.seconds[name], self.calls[name]) for name in self.seconds}
+
+    def merge(self, stages: dict) -> None:
+        for name, (seconds, calls) in stages.items():
+            self.add(name, seconds, calls)
+
+    def peak_memory(self) -> dict:
+        if self.memory is not None:
+            return self.memory
+
+        memory = {}
+        rss = max_rss_mb()
+        if rss is not None:
+            memory['process_rss_mb'] = rss  # Lifetime peak of the process
+            # A peak raised during the job is the job's own, a lower one is hidden by an earlier job
+            memory['host_rss_mb'] = rss if rss > self.rss_before else None
+        if self.sync:
+            memory['device_mb'] = torch.cuda.max_memory_allocated(self.device) / 1024 ** 2
+        return memory
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.start
+        order = {name: i for i, name in enumerate(STAGES)}
+
+        with self.lock:
+            stages = {
+                name: {'seconds': self.seconds[name], 'calls': self.calls[name],
+                       'mean_ms': 1000 * self.seconds[name] / self.calls[name]}
+                for name in sorted(self.seconds, key=lambda name: order.get(name, len(order)))
+            }
+            frames, pixels = self.frames, self.pixels
+
+        return {
+            'elapsed': elapsed,
+            'frames': frames,
+            'fps': frames / elapsed if elapsed > 0 else 0.,
+            'megapixels_per_s': pixels / 1e6 / elapsed if elapsed > 0 else 0.,
+            'stages': stages,
+            'peak_memory': self.peak_memory(),
+        }
+
+
+class MetricsLog:
+    # Appends metric events to a JSON lines file, one object per line
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, event: dict) -> None:
+        line = json.dumps(event, default=str) + '\n'
+        with self.lock, open(self.path, 'a') as f:
+            f.write(line)
@@ -0,0 +1,61 @@
+import torch
+
+from collections import OrderedDict
+
+from config import MODEL_CACHE_BYTES
+
+
+def model_bytes(model: torch.nn.Module) -> int:
+    tensors = [*model.parameters(), *model.buffers()]
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class ModelCache:
+    """
+    Keeps constructed, eval-mode models keyed by (model name, device, dtype).
+    The least recently used models are evicted once the cache goes over max_bytes,
+    the most recent one is always kept.
+    """
+    def __init__(self, loader, max_bytes: int = MODEL_CACHE_BYTES) -> None:
+        self.loader = loader  # loader(model_name, device) -> nn.Module
+        self.max_bytes = max_bytes
+        self.models = OrderedDict()
+        self.sizes = {}
+
+    def __contains__(self, key) -> bool:
+        return key in self.models
+
+    def __len__(self) -> int:
+        return len(self.models)
+
+    def total_bytes(self) -> int:
+        return sum(self.sizes.values())
+
+    def get(self, model_name: str, device: str, dtype: torch.dtype = torch.float32) -> torch.nn.Module:
+        key = (model_name, str(device), dtype)
+
+        if key in self.models:
+            self.models.move_to_end(key)
+            return self.models[key]
+
+        model = self.loader(model_name, device).to(dtype)
+        self.models[key] = model
+        self.sizes[key] = model_bytes(model)
+        self._evict()
+
+        return model
+
+    def clear(self) -> None:
+        for key in list(self.models):
+            self._remove(key)
+
+    def _evict(self) -> None:
+        while len(self.models) > 1 and self.total_bytes() > self.max_bytes:
+            self._remove(next(iter(self.models)))
+
+    def _remove(self, key) -> None:
+        del self.models[key]
+        del self.sizes[key]
+
+        if key[1].startswith('cuda'):
+            torch.cuda.empty_cache()
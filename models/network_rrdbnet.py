@@ -10,6 +10,8 @@ def initialize_weights(net_l, scale=1):
         net_l = [net_l]
     for net in net_l:
         for m in net.modules():
+            if getattr(m, 'weight', None) is not None and m.weight.is_meta:
+                continue  # Built to be loaded with assign=True, nothing to initialize
             if isinstance(m, nn.Conv2d):
                 init.kaiming_normal_(m.weight, a=0, mode='fan_in')
                 m.weight.data *= scale  # for residual block
@@ -32,10 +34,55 @@ def make_layer(block, n_layers):
     return nn.Sequential(*layers)
 
 
+class Float32Conv2d(nn.Conv2d):
+    '''Conv2d that always runs in float32, also under reduced precision autocast'''
+
+    def forward(self, x):
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            return super(Float32Conv2d, self).forward(x.float())
+
+
+def _eager(x):
+    # The dense path caches a buffer in Python, tracers and compilers get the reference graph
+    if isinstance(x, torch.fx.Proxy) or torch.jit.is_tracing() or torch.jit.is_scripting():
+        return False
+    return not torch.compiler.is_compiling()
+
+
+RES_SCALE = 0.2  # Residual scaling of ResidualDenseBlock_5C
+
+
+def fold_residual_scaling(state_dict):
+    '''State dict with RES_SCALE folded into every conv5, for networks built with enable_dense_execution(folded=True)'''
+    return {name: tensor * RES_SCALE if name.split('.')[-2] == 'conv5' else tensor
+            for name, tensor in state_dict.items()}
+
+
+class DenseBuffer(object):
+    '''Feature buffer shared by the dense blocks of a network, held for one pass through the trunk'''
+
+    def __init__(self):
+        self.tensor = None
+
+    def get(self, x, channels):
+        n, _, h, w = x.shape
+        t = self.tensor
+        if t is None or t.shape != (n, channels, h, w) or t.dtype != x.dtype or t.device != x.device:
+            self.tensor = t = torch.empty((n, channels, h, w), dtype=x.dtype, device=x.device)
+        return t
+
+    def release(self):
+        self.tensor = None
+
+
 class ResidualDenseBlock_5C(nn.Module):
     def __init__(self, nf=64, gc=32, bias=True):
         super(ResidualDenseBlock_5C, self).__init__()
         # gc: growth channel, i.e. intermediate channels
+        self.nf = nf
+        self.gc = gc
+        self.res_scale = RES_SCALE  # 1 once folded into conv5, see RRDBNet.enable_dense_execution
+        self.buffer = None  # DenseBuffer, while dense execution is enabled
         self.conv1 = nn.Conv2d(nf, gc, 3, 1, 1, bias=bias)
         self.conv2 = nn.Conv2d(nf + gc, gc, 3, 1, 1, bias=bias)
         self.conv3 = nn.Conv2d(nf + 2 * gc, gc, 3, 1, 1, bias=bias)
@@ -47,12 +94,29 @@ class ResidualDenseBlock_5C(nn.Module):
         initialize_weights([self.conv1, self.conv2, self.conv3, self.conv4, self.conv5], 0.1)
 
     def forward(self, x):
+        # With more than one frame the channel prefixes of the buffer are strided and the convolutions
+        # copy them, which measured no faster than concatenating (benchmark.py --dense-blocks)
+        if self.buffer is not None and x.shape[0] == 1 and _eager(x):
+            return self.forward_dense(x)
+
         x1 = self.lrelu(self.conv1(x))
         x2 = self.lrelu(self.conv2(torch.cat((x, x1), 1)))
         x3 = self.lrelu(self.conv3(torch.cat((x, x1, x2), 1)))
         x4 = self.lrelu(self.conv4(torch.cat((x, x1, x2, x3), 1)))
         x5 = self.conv5(torch.cat((x, x1, x2, x3, x4), 1))
-        return x5 * 0.2 + x
+        return x5 * self.res_scale + x
+
+    def forward_dense(self, x):
+        # x and the growth channels are written once into [x, x1, x2, x3, x4], each conv reads a prefix of it
+        nf, gc = self.nf, self.gc
+        feat = self.buffer.get(x, nf + 4 * gc)
+        feat[:, :nf].copy_(x)
+
+        for i, conv in enumerate((self.conv1, self.conv2, self.conv3, self.conv4)):
+            channels = nf + i * gc
+            feat[:, channels:channels + gc].copy_(self.lrelu(conv(feat[:, :channels])))
+
+        return self.conv5(feat).add_(x)  # The 0.2 scaling is in conv5's weights
 
 
 class RRDB(nn.Module):
@@ -68,6 +132,8 @@ class RRDB(nn.Module):
         out = self.RDB1(x)
         out = self.RDB2(out)
         out = self.RDB3(out)
+        if self.RDB3.buffer is not None and _eager(x):
+            return torch.add(x, out, alpha=0.2, out=out)  # out is a fresh tensor, scaled and added in one pass
         return out * 0.2 + x
 
 
@@ -86,13 +152,38 @@ class RRDBNet(nn.Module):
         if self.sf==4:
             self.upconv2 = nn.Conv2d(nf, nf, 3, 1, 1, bias=True)
         self.HRconv = nn.Conv2d(nf, nf, 3, 1, 1, bias=True)
-        self.conv_last = nn.Conv2d(nf, out_nc, 3, 1, 1, bias=True)
+        # conv_last produces the image, keep it in float32
+        self.conv_last = Float32Conv2d(nf, out_nc, 3, 1, 1, bias=True)
 
         self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True)
+        self.dense_buffer = None  # DenseBuffer of the trunk, while dense execution is enabled
+
+    @torch.no_grad()
+    def enable_dense_execution(self, folded=False):
+        '''
+        Inference mode of the dense blocks: the 0.2 residual scaling of every ResidualDenseBlock_5C is folded
+        into its conv5 weights and, for single frames, the blocks share one preallocated feature buffer instead
+        of concatenating. Call once, after loading the weights, with folded=True when they went through
+        fold_residual_scaling (memory-mapped weights are not written to). Traced and compiled graphs keep the
+        concatenations. The buffer is freed after the trunk, it is as large as the 192 channel features of a frame.
+        '''
+        buffer = self.dense_buffer = self.dense_buffer or DenseBuffer()
+        for m in self.modules():
+            if isinstance(m, ResidualDenseBlock_5C) and m.buffer is None:
+                if not folded:
+                    m.conv5.weight.mul_(m.res_scale)
+                    if m.conv5.bias is not None:
+                        m.conv5.bias.mul_(m.res_scale)
+                m.res_scale = 1.
+                m.buffer = buffer
+        return self
 
     def forward(self, x):
         fea = self.conv_first(x)
-        trunk = self.trunk_conv(self.RRDB_trunk(fea))
+        trunk = self.RRDB_trunk(fea)
+        if self.dense_buffer is not None:
+            self.dense_buffer.release()
+        trunk = self.trunk_conv(trunk)
         fea = fea + trunk
 
         fea = self.lrelu(self.upconv1(F.interpolate(fea, scale_factor=2, mode='nearest')))
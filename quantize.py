@@ -0,0 +1,125 @@
+import argparse
+import json
+import os
+import random
+import sys
+
+import numpy as np
+import torch
+
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+from PIL import Image
+
+from ai import load_model
+from cli import collect_files
+from models.network_rrdbnet import Float32Conv2d
+from utils import FrameConverter, psnr
+from engine import quantized_path
+from config import MODELS, IMAGE_EXTENSIONS
+
+
+def sample_crops(filepaths: list, count: int, crop: int, seed: int = 0) -> list:
+    # Random RGB crops of the sample images, one per image and cycling through them
+    rng = random.Random(seed)
+    crops = []
+
+    for i in range(count):
+        image = np.asarray(Image.open(filepaths[i % len(filepaths)]).convert('RGB'))
+        h, w = image.shape[:2]
+        size_h, size_w = min(crop, h), min(crop, w)
+        y, x = rng.randint(0, h - size_h), rng.randint(0, w - size_w)
+        crops.append(np.ascontiguousarray(image[y:y + size_h, x:x + size_w]))
+
+    return crops
+
+
+def quantize(model, crops: list, backend: str = 'x86'):
+    """
+    Static int8 quantization of a float RRDBNet, calibrated on crops (RGB uint8 arrays).
+    conv_last is left in float32, like under reduced precision autocast.
+    """
+    torch.backends.quantized.engine = backend
+    converter = FrameConverter('cpu')
+
+    # Quantized leaky_relu has no in-place variant
+    for module in model.modules():
+        if isinstance(module, torch.nn.LeakyReLU):
+            module.inplace = False
+
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    custom_config = PrepareCustomConfig().set_non_traceable_module_classes([Float32Conv2d])
+    example = converter.to_tensor(crops[:1]).clone()
+
+    prepared = prepare_fx(model, qconfig_mapping, (example, ), prepare_custom_config=custom_config)
+
+    with torch.no_grad():
+        for crop in crops:
+            prepared(converter.to_tensor([crop]))
+
+    quantized = convert_fx(prepared)
+
+    # TorchScript so upscale_process can load it without this module's setup
+    with torch.no_grad():
+        return torch.jit.freeze(torch.jit.trace(quantized.eval(), example, check_trace=False))
+
+
+def quality_report(model, quantized, crops: list) -> dict:
+    # PSNR of the int8 outputs against the float model on the calibration crops
+    converter = FrameConverter('cpu')
+    values = []
+
+    with torch.no_grad():
+        for crop in crops:
+            img_L = converter.to_tensor([crop]).clone()
+            reference = converter.from_tensor(model(img_L))[0].copy()
+            output = converter.from_tensor(quantized(img_L))[0]
+            values.append(psnr(reference, output))
+
+    return {
+        'samples': len(values),
+        'psnr_mean': float(np.mean(values)),
+        'psnr_min': float(np.min(values)),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Calibrate and save an int8 version of a model_zoo checkpoint')
+    parser.add_argument('model', choices=MODELS)
+    parser.add_argument('images', nargs='+', help='sample images, directories or glob patterns')
+    parser.add_argument('-n', '--samples', type=int, default=32, help='number of calibration crops')
+    parser.add_argument('-c', '--crop', type=int, default=128, help='calibration crop size in pixels')
+    parser.add_argument('--backend', default='x86', choices=('x86', 'fbgemm', 'qnnpack'))
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    filepaths = [f for f in collect_files(args.images) if f.split('.')[-1].lower() in IMAGE_EXTENSIONS]
+    if not filepaths:
+        print('No sample images found', file=sys.stderr)
+        return 1
+
+    crops = sample_crops(filepaths, args.samples, args.crop)
+
+    model = load_model(args.model, 'cpu')
+    quantized = quantize(load_model(args.model, 'cpu'), crops, args.backend)
+
+    path = quantized_path(args.model)
+    torch.jit.save(quantized, path)
+
+    report = quality_report(model, quantized, crops)
+    report.update({'model': args.model, 'backend': args.backend, 'crop': args.crop})
+
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'Saved {path}')
+    print(f'PSNR vs float: mean {report["psnr_mean"]:.2f} dB, min {report["psnr_min"]:.2f} dB over {report["samples"]} crops')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
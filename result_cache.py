@@ -0,0 +1,124 @@
+import hashlib
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+from config import RESULT_CACHE_FOLDER, RESULT_CACHE_BYTES
+
+
+def hash_image(image: Image.Image) -> str:
+    h = hashlib.sha256()
+    h.update(f'{image.mode}{image.size}'.encode())
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def hash_file(filepath: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def result_key(content_hash: str, **settings) -> str:
+    # Key of an upscaled result: the input content plus every setting that changes the output
+    h = hashlib.sha256(content_hash.encode())
+    for name in sorted(settings):
+        h.update(f'|{name}={settings[name]}'.encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of upscaled results keyed by result_key, with LRU eviction once the stored files
+    go over max_bytes. Hits refresh the file modification time, which is the LRU order.
+    """
+    def __init__(self, folder: str = RESULT_CACHE_FOLDER, max_bytes: int = RESULT_CACHE_BYTES) -> None:
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.folder, key[:2], f'{key}.{extension}')
+
+    def _entries(self) -> list:
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def _hit(self, path: str) -> bool:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _store(self, path: str, write) -> None:
+        # Write through a temporary file so readers never see partial results
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        os.close(fd)
+        try:
+            write(temp_path)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        self.total_bytes += os.path.getsize(path)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> None:
+        entries = sorted(self._entries())
+        self.total_bytes = sum(size for _, _, size in entries)
+
+        for _, path, size in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Evicted by another process
+            self.total_bytes -= size
+
+    def get_image(self, key: str):
+        path = self._path(key, 'png')
+        if not self._hit(path):
+            return None
+
+        try:
+            image = Image.open(path)
+            image.load()
+        except FileNotFoundError:
+            return None
+        return image
+
+    def put_image(self, key: str, image: Image.Image) -> None:
+        self._store(self._path(key, 'png'), lambda path: image.save(path, format='PNG', compress_level=1))
+
+    def get_file(self, key: str, extension: str, destination: str) -> bool:
+        # Copy a cached file result to destination, False on a miss
+        path = self._path(key, extension)
+        if not self._hit(path):
+            return False
+
+        try:
+            shutil.copyfile(path, destination)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put_file(self, key: str, extension: str, source: str) -> None:
+        self._store(self._path(key, extension), lambda path: shutil.copyfile(source, path))
@@ -1,13 +1,9 @@
 import tkinter as tk
-import torch
-import asyncio
+import itertools
+import multiprocessing
 import threading
-import time
-import math
+import traceback
 import os
-import numpy as np
-import cv2
-from moviepy.editor import *
 
 from control_panel import ControlPanel
 from work_area import WorkArea
@@ -15,32 +11,45 @@ from footer import Footer
 from card import Card
 from slider import Slider
 
-from ai import upscale_process
-from config import PRIMARY_BG, SECONDARY_BG, DEFAULT_OUTPUT_FOLDER, IMAGE_EXTENSIONS, VIDEO_EXTENSIONS
+from daemon import upscale_process
+from transport import Frame, FrameRing, pack_image, unpack_image
+from config import PRIMARY_BG, SECONDARY_BG, DEFAULT_OUTPUT_FOLDER, IMAGE_EXTENSIONS, VIDEO_EXTENSIONS, ALL_DEVICES, TILE_SIZE, TILE_OVERLAP, BATCH_SIZE, PRECISIONS, ENGINES, REUSE_THRESHOLD, PRIORITY_PREVIEW, PRIORITY_IMAGE, PRIORITY_VIDEO, FRAME_POLL, PREVIEW_MARGIN
 
 from tkinter.filedialog import askopenfilenames, askdirectory
 from tkinter import ttk
-from PIL import ImageTk, Image
+from PIL import Image
 
 
-# TO DO: Make a scrollbar for the footer
-MAX_FILES_OPEN = 18
-
 
 class MainApplication(tk.Frame):
-    def __init__(self, parent, conn, *args, **kwargs):
+    def __init__(self, parent, conn, input_ring=None, output_ring=None, *args, **kwargs):
         tk.Frame.__init__(self, parent, *args, **kwargs)
         self.parent = parent
         self.parent.title('Ceibo Upscaling Lab')
 
-        # Connection to other process
+        # Connection to other process, frames go through the shared memory rings
         self.conn = conn
+        self.input_ring = input_ring
+        self.output_ring = output_ring
+
+        # Jobs sent to the upscaling process, the listener routes its messages to them by job id
+        self.job_ids = itertools.count(1)
+        self.jobs = {}
+        threading.Thread(target=self.listen, daemon=True).start()
 
         # PARAMS
         self.model = 'BSRGAN'
-        self.gpu_id = torch.cuda.current_device()
+        self.gpu_id = 0  # Until the upscaling process reports its devices
         self.output_format = 'png'
         self.output_folder = DEFAULT_OUTPUT_FOLDER
+        self.tile_size = TILE_SIZE
+        self.tile_overlap = TILE_OVERLAP
+        self.batch_size = BATCH_SIZE
+        self.precision = PRECISIONS[0]
+        self.engine = ENGINES[0]
+        self.reuse_threshold = REUSE_THRESHOLD
+        self.frame_poll = None  # after() id while waiting for a video frame
+        self.preview_job = None  # Job id of the region preview in flight
 
         # TKINTER FRAMES
         self.upper_frame = tk.Frame(self)
@@ -59,6 +68,8 @@ class MainApplication(tk.Frame):
         # EVENTS
         self.control_panel.on_model_change(self.change_model)
         self.control_panel.on_gpu_change(self.change_gpu)
+        self.control_panel.on_precision_change(self.change_precision)
+        self.control_panel.on_engine_change(self.change_engine)
         self.control_panel.on_output_format_change(self.output_format_change)
         self.control_panel.on_output_folder_change(self.change_output_folder)
         self.control_panel.on_select_folder(self.select_folder)
@@ -71,6 +82,7 @@ class MainApplication(tk.Frame):
         self.work_area.on_file_close(self.close_file)
         self.work_area.on_reset(self.reset_image)
         self.work_area.on_see_original(self.see_original)
+        self.work_area.on_region_selected(self.preview_region)
 
         self.footer.on_footer_change(self.update_footer)
         self.footer.on_card_selected(self.card_selected)
@@ -80,13 +92,22 @@ class MainApplication(tk.Frame):
         # PACK FRAMES
         self.upper_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
         self.lower_frame.pack(side=tk.TOP, fill=tk.X)
+
+        # The upscaling process answers once torch is loaded, the window does not wait for it
+        self.conn.send(('devices', ))
     
     #########################################  EVENTS  #########################################
     def change_model(self, model_selector):
         self.model = model_selector.get()
 
     def change_gpu(self, gpu_selector):
-        self.gpu_id = gpu_selector.current()
+        self.gpu_id = 'all' if gpu_selector.get() == ALL_DEVICES else gpu_selector.current()
+
+    def change_precision(self, precision_selector):
+        self.precision = precision_selector.get()
+
+    def change_engine(self, engine_selector):
+        self.engine = engine_selector.get()
 
     def output_format_change(self, output_format_selector):
         self.output_format = output_format_selector.get()
@@ -110,8 +131,7 @@ class MainApplication(tk.Frame):
         file_name = self.work_area.card.image['path'].split('/')[-1]
         file_name = file_name.split('.')[0] + '_upscaled_'
         filepath = os.path.join(self.output_folder, f'{file_name}.{self.output_format}')
-        image_tk = self.work_area.card.image['output']
-        image = ImageTk.getimage(image_tk)
+        image = self.work_area.card.image['output']
         image.save(filepath)
 
     def open_file(self):
@@ -123,16 +143,16 @@ class MainApplication(tk.Frame):
 
         if len(filepaths) == 0:
             return
-        
-        filepaths = filepaths[:MAX_FILES_OPEN]
-        
-        for i, filepath in enumerate(filepaths):
-            self.footer.create_card(filepath, i)
-                
+
+        # Cards read nothing until shown, so any number of files opens at once
+        first = len(self.footer.cards)
+        for filepath in filepaths:
+            self.footer.create_card(filepath)
+
         self.footer.update_grid()
 
-        # Load to workplace the first thumbnail
-        self.select_card_by_index(0)
+        # Load to workplace the first opened file
+        self.select_card_by_index(first)
     
     def card_selected(self, card: Card):
         self.select_card_by_index(card.index)
@@ -163,12 +183,29 @@ class MainApplication(tk.Frame):
         self.work_area.show_image()
     
     def slider_change(self, value):
-        # On slider change create a new card with the selected frame loaded
+        # On slider change show the selected frame, now if it is cached or once it is decoded
         value = round(float(value))
         card = self.footer.get_current_card()
-        card.select_video_frame(value)
         self.control_panel.set_video_length(value)
-        self.work_area.update_image(card)
+
+        if self.frame_poll is not None:
+            self.after_cancel(self.frame_poll)
+            self.frame_poll = None
+
+        if card.select_video_frame(value) is not None:
+            self.work_area.update_image(card)
+        else:
+            self.frame_poll = self.after(FRAME_POLL, self.poll_video_frame, card)
+
+    def poll_video_frame(self, card):
+        self.frame_poll = None
+        if card is not self.footer.get_current_card():
+            return
+
+        if card.poll_video_frame():
+            self.work_area.update_image(card)
+        else:
+            self.frame_poll = self.after(FRAME_POLL, self.poll_video_frame, card)
 
     def update_footer(self, _):
         self.footer.update_grid()
@@ -202,18 +239,79 @@ class MainApplication(tk.Frame):
 
         card = self.footer.get_current_card()
         path, image = card.image['path'], card.image['file']
-        self.upscale(path, (image, ))
+        self.upscale(path, (image, ), PRIORITY_IMAGE)
     
+    def preview_region(self, box):
+        # Upscales only the selected region, the full image is upscaled once confirmed with the upscale button
+        card = self.footer.get_current_card()
+        image = card.image['file']
+        if image is None:
+            return
+
+        # The crop gets some context around the region so its borders match the full upscale
+        left, top, right, bottom = box
+        crop_box = (max(left - PREVIEW_MARGIN, 0), max(top - PREVIEW_MARGIN, 0),
+                    min(right + PREVIEW_MARGIN, image.width), min(bottom + PREVIEW_MARGIN, image.height))
+
+        # Only the last selection matters
+        if self.preview_job is not None:
+            self.conn.send(('cancel', self.preview_job))
+
+        job_id = next(self.job_ids)
+        self.preview_job = job_id
+        self.work_area.show_status('')
+        self.jobs[job_id] = {
+            'write': lambda _: None,
+            'close': lambda: None,
+            'card': card,
+            'preview': (image, box, crop_box),
+        }
+
+        crop = pack_image(self.input_ring, image.crop(crop_box), timeout=0)  # Never wait on the Tk thread
+        self.conn.send(('submit', job_id, PRIORITY_PREVIEW, [self.model, self.gpu_id, card.image['path'], [crop], self.upscale_options()]))
+
+    def show_preview(self, job, output):
+        # Pastes the upscaled region, without its margin, over the image it was cropped from
+        image, box, crop_box = job['preview']
+        if not self.is_current_card(job['card']) or job['card'].image['file'] is not image:
+            return
+
+        left, top = box[0] - crop_box[0], box[1] - crop_box[1]
+        region = output.crop((left, top, left + box[2] - box[0], top + box[3] - box[1]))
+
+        composite = image.convert(region.mode)
+        composite.paste(region, box[:2])
+        self.work_area.show_preview(composite, box)
+
     def upscale_and_save_video(self):
         start = int(self.control_panel.start_entry.get())
         end = int(self.control_panel.end_entry.get())
 
         card = self.footer.get_current_card()
-        images = [image['file'] for image in card.select_subclip(start, end)]
-        self.upscale(card.image['path'], images)
+        filename = card.image['path'].split('/')[-1]  # Remove path
+        filename = filename.split('.')[0]  # Remove extension
+        extension = 'mp4'
+        filepath = os.path.join(self.output_folder, f'{filename}_upscaled_.{extension}')
+
+        # Frames are decoded and the video written by the upscaling process
+        self.upscale(card.image['path'], None, PRIORITY_VIDEO, subclip=(start, end), output_path=filepath)
     
     #########################################  METHODS  #########################################
-    def upscale(self, path, images):        
+    def upscale_options(self, **kwargs) -> dict:
+        # Inference settings sent along with every request
+        return {
+            'tile': self.tile_size,
+            'tile_overlap': self.tile_overlap,
+            'batch_size': self.batch_size,
+            'precision': self.precision,
+            'engine': self.engine,
+            'reuse_threshold': self.reuse_threshold,
+            **kwargs,
+        }
+
+    def upscale(self, path, images, priority, **kwargs):
+        job_id = next(self.job_ids)
+
         modal = tk.Toplevel(self, padx=15, pady=15, background=PRIMARY_BG)
         modal.title('Upscaling')
 
@@ -240,85 +338,131 @@ class MainApplication(tk.Frame):
         txt_messages.config(highlightbackground=SECONDARY_BG, font=('Segoe Ui', 10), state='disabled', fg='white')
         txt_messages.pack(side=tk.TOP, fill=tk.X, pady=(5,))
 
-        # Close button
-        close_btn = ttk.Button(modal, text='Wait', command=modal.destroy, state='disabled')
+        # Cancel button, turns into the close button once the job ends
+        close_btn = ttk.Button(modal, text='Cancel', command=lambda: self.conn.send(('cancel', job_id)))
         close_btn.pack(side=tk.TOP)
 
-        # Send images to scaling process
-        self.conn.send([self.model, self.gpu_id, path, images])
-
-        # Wait for process to finish
-        threading.Thread(target=lambda loop: loop.run_until_complete(self.wait_for_upscaled_images(txt_messages, close_btn, is_video=len(images) > 1)),
-                         args=(asyncio.new_event_loop(),)).start()
-
-    
-    async def wait_for_upscaled_images(self, txt_messages, close_btn, is_video):
         def write_message(message):
             txt_messages.config(state='normal')
             txt_messages.insert(tk.END, f'{message}\n')
             txt_messages.config(state='disabled')
             txt_messages.see(tk.END)
-        
-        index = self.footer.current_card_index()
-        card = self.footer.get_current_card()
-        video_buffer = []
 
-        while True:
-            self.conn.poll(timeout=None)
-            message = self.conn.recv()
+        def close():
+            close_btn.config(text='Close', command=modal.destroy)
 
-            if isinstance(message, Image.Image):
-                output_image = ImageTk.PhotoImage(message)
-                card.image['output'] = output_image
+        self.jobs[job_id] = {
+            'write': write_message,
+            'close': close,
+            'card': self.footer.get_current_card(),
+        }
 
-                if not is_video:
-                    # Is image
-                    # Update card with output
-                    self.footer.update_card(card, index)
-                    self.work_area.update_image(card)
-                else:
-                    # Is video
-                    image = np.array(ImageTk.getimage(output_image))  # PIL to opencv
-                    video_buffer.append(image)
-                    
-            elif message == 'done':
-                if is_video:
-                    # Is video
-                    # Save video
-                    fps = card.fps
-                    filename = card.image['path'].split('/')[-1]  # Remove path
-                    filename = filename.split('.')[0]  # Remove extension
-                    extension = 'mp4'
-                    filepath = os.path.join(self.output_folder, f'{filename}_upscaled_.{extension}')
-
-                    start = int(self.control_panel.start_entry.get())
-                    end = int(self.control_panel.end_entry.get())
-                    audio = AudioFileClip(card.image['path']).subclip(start / fps, end / fps)
-
-                    write_message('Saving video:')
-                    write_message(filepath)
-
-                    final = ImageSequenceClip(video_buffer, fps=fps).set_audio(audio)
-                    final.write_videofile(filepath, fps=fps)
+        def modal_closed():
+            # The job keeps running without its modal
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job['write'] = job['close'] = lambda *_: None
+            modal.destroy()
 
+        modal.protocol('WM_DELETE_WINDOW', modal_closed)
+
+        # Send images to scaling process
+        if images is not None:
+            # Never wait on the Tk thread, images that find their slot still taken go through the pipe
+            images = [pack_image(self.input_ring, image, timeout=0) for image in images]
+        self.conn.send(('submit', job_id, priority, [self.model, self.gpu_id, path, images, self.upscale_options(**kwargs)]))
+
+    def listen(self):
+        # Messages of the upscaling process are (job_id, message) pairs
+        while True:
+            try:
+                job_id, message = self.conn.recv()
+            except (EOFError, OSError):
                 break
-            else:
-                write_message(message)
 
-        write_message('Done!')
-        close_btn.config(text='Close', state='normal')
-        if self.footer.get_current_card().is_image:
-            self.control_panel.btn_save.pack(side=tk.BOTTOM, pady=(0, 15))
+            # A failing handler must not stop the listener, every later job would hang
+            try:
+                self.dispatch(job_id, message)
+            except Exception:
+                traceback.print_exc()
+
+    def dispatch(self, job_id, message):
+        job = self.jobs.get(job_id)
+
+        if job_id is None and isinstance(message, dict) and 'devices' in message:
+            self.control_panel.set_devices(message['devices'])
+
+        elif isinstance(message, (Frame, Image.Image)):
+            # Always unpacked, so the slot is released even for a closed job
+            output = unpack_image(self.output_ring, message)
+
+            if job is not None and 'preview' in job:
+                self.show_preview(job, output)
+            elif job is not None:
+                # Update card with output, shown if it is still the selected one
+                card = job['card']
+                card.image['output'] = output
+                if self.is_current_card(card):
+                    self.work_area.update_image(card)
+
+        elif isinstance(message, dict):
+            if job is None:
+                return
+            if 'status' in message:
+                self.job_status(job_id, job, message)
+            elif message.get('event') == 'job' and message['frames']:
+                # Per frame events are for logs and tools, the modal only shows the job totals
+                job['write'](f'{message["fps"]:.2f} frames/s, {message["megapixels_per_s"]:.2f} megapixels/s')
+
+        elif job is not None:
+            job['write'](message)
+
+    def is_current_card(self, card) -> bool:
+        return self.footer.current_card_index() is not None and card is self.footer.get_current_card()
+
+    def job_status(self, job_id, job, message):
+        status = message['status']
+
+        if status == 'queued':
+            if message['position'] > 0:
+                job['write'](f'Queued, {message["position"]} job(s) ahead')
+            return
+        if status == 'running':
+            return
+
+        # Job ended
+        del self.jobs[job_id]
+
+        if 'preview' in job:
+            if self.preview_job == job_id:
+                self.preview_job = None
+            if status == 'failed' and self.is_current_card(job['card']):
+                self.work_area.show_status(f'Preview failed: {message["error"]}')
+            return
+
+        if status == 'done':
+            job['write']('Done!')
+            if job['card'].is_image and self.is_current_card(job['card']):
+                self.control_panel.btn_save.pack(side=tk.BOTTOM, pady=(0, 15))
+        elif status == 'cancelled':
+            job['write']('Cancelled')
+        else:
+            job['write'](f'Failed: {message["error"]}')
+
+        job['close']()
 
 
 if __name__ == '__main__':
-    torch.multiprocessing.set_start_method('spawn')
+    multiprocessing.set_start_method('spawn')
 
     # Comunications between processes
-    ui_conn, ai_conn = torch.multiprocessing.Pipe(duplex=True)
+    ui_conn, ai_conn = multiprocessing.Pipe(duplex=True)
+
+    # Shared memory for frames, UI -> AI and AI -> UI
+    input_ring, output_ring = FrameRing(), FrameRing()
 
-    # UPSCALING PROCESS
-    upscaling_daemon = torch.multiprocessing.Process(target=upscale_process, args=(ai_conn,), daemon=True)
+    # UPSCALING PROCESS, it loads torch and the models while the window opens
+    upscaling_daemon = multiprocessing.Process(target=upscale_process, args=(ai_conn, input_ring.name, output_ring.name), daemon=True)
     upscaling_daemon.start()
     
     # APP
@@ -328,5 +472,9 @@ if __name__ == '__main__':
     root.tk.call('source', 'azure.tcl')
     root.tk.call('set_theme', 'dark')
 
-    MainApplication(root, ui_conn).pack(side='top', fill='both', expand=True)
+    MainApplication(root, ui_conn, input_ring, output_ring).pack(side='top', fill='both', expand=True)
     root.mainloop()
+
+    upscaling_daemon.terminate()
+    input_ring.close()
+    output_ring.close()
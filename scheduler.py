@@ -0,0 +1,110 @@
+import heapq
+import itertools
+import threading
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    Upscaling request queued in the daemon. request is [model_name, gpu_id, filepath, images, options],
+    images is None for videos. Lower priority values run first.
+    """
+    def __init__(self, job_id: int, priority: int, request: list) -> None:
+        self.id = job_id
+        self.priority = priority
+        self.request = request
+        self.status = 'queued'
+        self.cancel_event = threading.Event()
+
+    @property
+    def is_video(self) -> bool:
+        return self.request[3] is None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+    def check(self) -> None:
+        # Called between frames and batches, ends a running job once it is cancelled
+        if self.cancelled:
+            raise JobCancelled(self.id)
+
+
+class JobQueue:
+    """
+    Thread-safe priority queue of jobs, first in first out within a priority.
+    Jobs stay listed by id until they finish so their status can be reported.
+    """
+    def __init__(self) -> None:
+        self.jobs = {}  # id -> queued or running Job
+        self.heap = []
+        self.seq = itertools.count()
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def submit(self, job: Job) -> int:
+        # Returns the job position in the queue, 0 runs next
+        with self.condition:
+            job.order = (job.priority, next(self.seq))
+            self.jobs[job.id] = job
+            heapq.heappush(self.heap, (*job.order, job))
+            self.condition.notify()
+            return self.position(job)
+
+    def position(self, job: Job) -> int:
+        with self.condition:
+            return sum(1 for *order, other in self.heap if other.status == 'queued' and tuple(order) < job.order)
+
+    def cancel(self, job_id: int):
+        """
+        Cancel a job: a queued job is dropped at once, a running one stops at its next check.
+        Returns the job, or None when it is unknown or already finished.
+        """
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+
+            job.cancel_event.set()
+            if job.status == 'queued':
+                self.finish(job, 'cancelled')
+            return job
+
+    def pop(self, before: int = None, videos: bool = True):
+        """
+        Next job to run, marked as running. With before only jobs of a lower priority value are taken and
+        the call never blocks. Returns None when nothing fits, or once the queue is closed.
+        """
+        with self.condition:
+            while True:
+                # Finished jobs are removed lazily
+                while self.heap and self.heap[0][2].status != 'queued':
+                    heapq.heappop(self.heap)
+
+                for priority, _, job in sorted(self.heap):
+                    if before is not None and priority >= before:
+                        break
+                    if job.status == 'queued' and (videos or not job.is_video):
+                        job.status = 'running'
+                        return job
+
+                if self.closed or before is not None:
+                    return None
+                self.condition.wait()
+
+    def finish(self, job: Job, status: str) -> None:
+        with self.condition:
+            job.status = status
+            self.jobs.pop(job.id, None)
+
+    def snapshot(self) -> list:
+        with self.condition:
+            return [{'id': job.id, 'priority': job.priority, 'status': job.status} for job in self.jobs.values()]
+
+    def close(self) -> None:
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
@@ -0,0 +1,99 @@
+import numpy as np
+
+from PIL import Image
+
+from config import REUSE_TILE, REUSE_MARGIN, REUSE_MAX_CHANGED
+
+
+class TemporalReuse:
+    """
+    Upscales a stream of frames re-inferring only what changed since the last inference.
+
+    Frames are compared per tile against the input that produced the current output, so small changes
+    cannot build up over time. Unchanged frames reuse the previous output, and changed tiles are
+    re-inferred as one batch of crops with `margin` pixels of context and pasted onto the previous output.
+    upscale maps a list of same-size PIL images to their outputs.
+    """
+    def __init__(self, upscale, threshold: int, tile: int = REUSE_TILE, margin: int = REUSE_MARGIN,
+                 max_changed: float = REUSE_MAX_CHANGED) -> None:
+        self.upscale = upscale
+        self.threshold = threshold  # Largest per pixel difference (0-255) that still counts as unchanged
+        self.tile = tile
+        self.margin = margin
+        self.max_changed = max_changed  # Above this fraction of changed tiles the whole frame is re-inferred
+
+        self.reference = None  # Input pixels behind the current output
+        self.output = None
+        self.output_image = None
+
+        self.frames_reused = 0
+        self.tiles_inferred = 0
+
+    def _changed_tiles(self, current: np.ndarray) -> np.ndarray:
+        diff = np.abs(current.astype(np.int16) - self.reference).max(axis=2)
+
+        h, w = diff.shape
+        grid_h, grid_w = -(-h // self.tile), -(-w // self.tile)
+        padded = np.zeros((grid_h * self.tile, grid_w * self.tile), dtype=diff.dtype)
+        padded[:h, :w] = diff
+
+        tiles = padded.reshape(grid_h, self.tile, grid_w, self.tile).max(axis=(1, 3))
+        return tiles > self.threshold
+
+    def _set_output(self, current: np.ndarray, output: np.ndarray) -> Image.Image:
+        self.reference = current.astype(np.int16)
+        self.output = output
+        self.output_image = Image.fromarray(output)
+        return self.output_image
+
+    def _full(self, frame: Image.Image, current: np.ndarray) -> Image.Image:
+        output, = self.upscale([frame])
+        return self._set_output(current, np.array(output))
+
+    def _window(self, start: int, size: int) -> tuple:
+        # Crop of tile + margins along one axis, shifted inside the frame so every crop has the same size
+        length = min(self.tile + 2 * self.margin, size)
+        origin = min(max(start - self.margin, 0), size - length)
+        return origin, length
+
+    def _partial(self, current: np.ndarray, changed: np.ndarray) -> Image.Image:
+        h, w = current.shape[:2]
+        tiles, crops = [], []
+
+        for ty, tx in zip(*np.nonzero(changed)):
+            y0, x0 = ty * self.tile, tx * self.tile
+            (cy, ch), (cx, cw) = self._window(y0, h), self._window(x0, w)
+            tiles.append((y0, min(y0 + self.tile, h), x0, min(x0 + self.tile, w), cy, cx))
+            crops.append(Image.fromarray(current[cy:cy + ch, cx:cx + cw]))
+
+        output = self.output.copy()
+        reference = self.reference.copy()
+
+        for (y0, y1, x0, x1, cy, cx), upscaled in zip(tiles, self.upscale(crops)):
+            upscaled = np.asarray(upscaled)
+            output[y0:y1, x0:x1] = upscaled[y0 - cy:y1 - cy, x0 - cx:x1 - cx]
+            reference[y0:y1, x0:x1] = current[y0:y1, x0:x1]
+
+        self.tiles_inferred += len(tiles)
+        self.output = output
+        self.reference = reference
+        self.output_image = Image.fromarray(output)
+        return self.output_image
+
+    def map(self, frames):
+        for frame in frames:
+            current = np.asarray(frame if frame.mode == 'RGB' else frame.convert('RGB'))
+
+            if self.reference is None or self.reference.shape != current.shape:
+                yield self._full(frame, current)
+                continue
+
+            changed = self._changed_tiles(current)
+
+            if not changed.any():
+                self.frames_reused += 1
+                yield self.output_image
+            elif changed.mean() > self.max_changed:
+                yield self._full(frame, current)
+            else:
+                yield self._partial(current, changed)
@@ -0,0 +1,96 @@
+import queue
+import threading
+
+from collections import OrderedDict
+
+from PIL import Image
+
+from config import IMAGE_EXTENSIONS, THUMBNAIL_SIZE, THUMBNAIL_WORKERS, THUMBNAIL_CACHE
+
+
+def make_thumbnail(filepath: str, size: int = THUMBNAIL_SIZE) -> tuple:
+    # (thumbnail, (w, h)) of an image or of the first frame of a video, reading as little as possible
+    if filepath.split('.')[-1] in IMAGE_EXTENSIONS:
+        image = Image.open(filepath)
+        full_size = image.size
+        image.draft('RGB', (size * 2, size * 2))  # JPEGs decode at a reduced scale
+    else:
+        import cv2  # Only loaded once there is a video
+
+        video_cap = cv2.VideoCapture(filepath)
+        res, frame = video_cap.read()
+        video_cap.release()
+        if not res:
+            raise ValueError(f'Cannot read {filepath}')
+        image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        full_size = image.size
+
+    image = image.convert('RGB')
+    image.thumbnail((size, size))
+    return image, full_size
+
+
+class ThumbnailLoader:
+    """
+    Decodes thumbnails in a pool of background threads and keeps the last `cache_size` of them.
+
+    request(paths) replaces the wanted list: paths are decoded in the given order and those no longer
+    wanted are skipped, so scrolling quickly through thousands of files only decodes what is shown.
+    Results are handed to on_ready(path) on the Tk thread, polled with widget.after.
+    """
+    def __init__(self, widget, on_ready, workers: int = THUMBNAIL_WORKERS, cache_size: int = THUMBNAIL_CACHE) -> None:
+        self.widget = widget
+        self.on_ready = on_ready
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # path -> (thumbnail, (w, h)), (None, None) when it failed
+        self.wanted = []
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.done = queue.SimpleQueue()
+
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+        self.widget.after(50, self._poll)
+
+    def get(self, path: str):
+        # Cached (thumbnail, (w, h)), None if not decoded yet
+        with self.condition:
+            if path in self.cache:
+                self.cache.move_to_end(path)
+                return self.cache[path]
+        return None
+
+    def request(self, paths: list) -> None:
+        with self.condition:
+            self.wanted = [path for path in reversed(paths) if path not in self.cache and path not in self.pending]
+            self.condition.notify_all()
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                while not self.wanted:
+                    self.condition.wait()
+                path = self.wanted.pop()
+                self.pending.add(path)
+
+            try:
+                result = make_thumbnail(path)
+            except Exception:
+                result = None, None  # Shown without a thumbnail
+
+            with self.condition:
+                self.pending.discard(path)
+                self.cache[path] = result
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            self.done.put(path)
+
+    def _poll(self) -> None:
+        while True:
+            try:
+                path = self.done.get_nowait()
+            except queue.Empty:
+                break
+            self.on_ready(path)
+        self.widget.after(50, self._poll)
@@ -0,0 +1,100 @@
+import time
+
+import numpy as np
+
+from collections import namedtuple
+from multiprocessing import shared_memory, resource_tracker
+
+from PIL import Image
+
+from config import FRAME_SLOTS, FRAME_SLOT_BYTES
+
+
+# Small message sent over the pipe in place of a frame, the pixels live in a ring slot
+Frame = namedtuple('Frame', ['slot', 'shape', 'dtype', 'seq'])
+
+FREE, FULL = 0, 1
+
+
+class FrameRing:
+    """
+    Single producer, single consumer ring buffer of fixed-size frame slots in shared memory.
+
+    The first `slots` bytes hold the state of every slot, the writer waits for a slot to be
+    released before reusing it. One ring is used per direction of the connection.
+    """
+    def __init__(self, name: str = None, slots: int = FRAME_SLOTS, slot_bytes: int = FRAME_SLOT_BYTES) -> None:
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.owner = name is None
+
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=slots + slots * slot_bytes)
+            self.shm.buf[:slots] = bytes(slots)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # The creating process owns the segment, do not let this process' tracker unlink it
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.states = np.ndarray((slots, ), dtype=np.uint8, buffer=self.shm.buf)
+        self.seq = 0
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def fits(self, array: np.ndarray) -> bool:
+        return array.nbytes <= self.slot_bytes
+
+    def _slot_array(self, slot: int, shape, dtype) -> np.ndarray:
+        offset = self.slots + slot * self.slot_bytes
+        return np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+
+    def write(self, array: np.ndarray, timeout: float = None):
+        # Copy array into the next slot, blocking while the reader still holds it.
+        # With a timeout (0 does not wait) returns None if the slot is still held by then
+        slot = self.seq % self.slots
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.states[slot] != FREE:
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(0.001)
+
+        self._slot_array(slot, array.shape, array.dtype)[...] = array
+        self.states[slot] = FULL
+
+        frame = Frame(slot, array.shape, array.dtype.str, self.seq)
+        self.seq += 1
+        return frame
+
+    def read(self, frame: Frame) -> np.ndarray:
+        # Copy a frame out of its slot and hand the slot back to the writer
+        array = self._slot_array(frame.slot, frame.shape, np.dtype(frame.dtype)).copy()
+        self.states[frame.slot] = FREE
+        return array
+
+    def release(self, frame: Frame) -> None:
+        # Hand a slot back without reading it, for frames of dropped jobs
+        self.states[frame.slot] = FREE
+
+    def close(self) -> None:
+        del self.states
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def pack_image(ring: FrameRing, image: Image.Image, timeout: float = None):
+    # Message to send for image, falls back to the image itself when it does not fit in a slot
+    # or when no slot is released within timeout (see FrameRing.write)
+    array = np.asarray(image if image.mode == 'RGB' else image.convert('RGB'))
+    if ring is None or not ring.fits(array):
+        return image
+    frame = ring.write(array, timeout)
+    return image if frame is None else frame
+
+
+def unpack_image(ring: FrameRing, message) -> Image.Image:
+    if isinstance(message, Frame):
+        return Image.fromarray(ring.read(message))
+    return message
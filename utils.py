@@ -1,5 +1,11 @@
+import functools
 import numpy as np
 import torch
+import torch.nn.functional as F
+
+from collections import OrderedDict
+
+from metrics import stage
 
 # convert uint to 4-dimensional torch tensor
 def uint2tensor4(img):
@@ -13,3 +19,85 @@ def tensor2uint(img):
     if img.ndim == 3:
         img = np.transpose(img, (1, 2, 0))
     return np.uint8((img*255.0).round())
+
+
+# peak signal to noise ratio between two uint8 images
+def psnr(img1, img2):
+    mse = np.mean((img1.astype(np.float64) - img2.astype(np.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return 20 * np.log10(255.0 / np.sqrt(mse))
+
+
+class FrameConverter:
+    """
+    Moves batches of RGB uint8 frames (NHWC) to the model and back.
+
+    Only uint8 data crosses between host and device, normalization and the RGB/BGR reorder run
+    on the device, and the buffers are allocated once per resolution and reused afterwards.
+    The arrays returned by from_tensor are views of a reused buffer, copy them to keep them.
+    """
+    def __init__(self, device, max_resolutions: int = 4) -> None:
+        self.device = torch.device(device)
+        self.pin = self.device.type == 'cuda'
+        self.max_resolutions = max_resolutions
+        self.buffers = OrderedDict()
+
+    def _buffer(self, name: str, shape: tuple, dtype: torch.dtype, device) -> torch.Tensor:
+        key = (name, shape, dtype, str(device))
+
+        if key in self.buffers:
+            self.buffers.move_to_end(key)
+            return self.buffers[key]
+
+        pin = self.pin and torch.device(device).type == 'cpu'
+        self.buffers[key] = torch.empty(shape, dtype=dtype, device=device, pin_memory=pin)
+
+        # Keep the buffers of the last few resolutions only (4 buffers per resolution)
+        while len(self.buffers) > self.max_resolutions * 4:
+            self.buffers.popitem(last=False)
+        return self.buffers[key]
+
+    def to_tensor(self, frames: list, metrics=None) -> torch.Tensor:
+        # List of HxWx3 RGB uint8 arrays -> Nx3xHxW BGR float tensor in [0, 1] on the device
+        n, (h, w, c) = len(frames), frames[0].shape
+
+        with stage(metrics, 'h2d', device=True):
+            host = self._buffer('host_in', (n, h, w, c), torch.uint8, 'cpu')
+            host_np = host.numpy()
+            for i, frame in enumerate(frames):
+                np.copyto(host_np[i], frame)
+
+            img = host.to(self.device, non_blocking=True)
+
+        with stage(metrics, 'convert', device=True):
+            # Cast, HWC -> CHW and RGB -> BGR in a single copy, then normalize in place
+            img_L = self._buffer('device_in', (n, c, h, w), torch.float32, self.device)
+            img_L.copy_(img.permute(0, 3, 1, 2).flip(1) if c == 3 else img.permute(0, 3, 1, 2))
+            return img_L.div_(255.)
+
+    def from_tensor(self, img_E: torch.Tensor, size: tuple = None, metrics=None) -> np.ndarray:
+        # Nx3xHxW BGR float tensor -> NxHxWx3 RGB uint8 array, optionally resized to size (w, h) first
+        if size is not None and (img_E.shape[3], img_E.shape[2]) != size:
+            with stage(metrics, 'resize', device=True):
+                img_E = F.interpolate(img_E, size=(size[1], size[0]), mode='bilinear', align_corners=False)
+
+        with stage(metrics, 'convert', device=True):
+            img_E = img_E.float().clamp_(0, 1).mul_(255.).round_()
+            n, c, h, w = img_E.shape
+
+            # Tiled outputs are already on the host
+            output = self._buffer('out', (n, h, w, c), torch.uint8, img_E.device)
+            for i in range(c):
+                output[..., i].copy_(img_E[:, c - 1 - i] if c == 3 else img_E[:, i])
+
+        if output.device.type != 'cpu':
+            with stage(metrics, 'd2h', device=True):
+                host = self._buffer('host_out', (n, h, w, c), torch.uint8, 'cpu')
+                output = host.copy_(output)
+        return output.numpy()
+
+@functools.lru_cache(maxsize=None)
+def frame_converter(device: str) -> FrameConverter:
+    # One converter, and so one set of buffers, per device
+    return FrameConverter(device)
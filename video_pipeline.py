@@ -0,0 +1,381 @@
+import os
+import json
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+import uuid
+
+import cv2
+import numpy as np
+
+from PIL import Image
+
+from config import PIPELINE_QUEUE_SIZE, CHUNK_FRAMES, SEGMENT_MIN_FRAMES
+from frame_service import keyframe_index
+from metrics import stage
+
+
+_END = object()  # Marks the end of a stage's output
+
+
+class _Stage(threading.Thread):
+    # Pipeline thread that keeps its exception and stops the other stages when it fails
+    def __init__(self, stop: threading.Event, target, *args):
+        threading.Thread.__init__(self, daemon=True)
+        self.stop = stop
+        self.target = target
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(*self.args)
+        except BaseException as e:
+            self.error = e
+            self.stop.set()
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    # Blocking put on a bounded queue that gives up once the pipeline is stopped
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    # Blocking get that ends the stream once the pipeline is stopped
+    while True:
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            if stop.is_set():
+                return _END
+
+
+def first_frame(start: int) -> int:
+    # 0-based index of the first frame of a [start, end) subclip, subclips count frames from 1 (0 is also the first)
+    return max(start - 1, 0)
+
+
+def decode_frames(path: str, first: int, count: int):
+    # Yields count frames from the 0-based frame first as PIL images, decoding sequentially after a single seek
+    video_cap = cv2.VideoCapture(path)
+    video_cap.set(cv2.CAP_PROP_POS_FRAMES, first)
+
+    try:
+        for _ in range(count):
+            res, frame = video_cap.read()
+
+            if not res:
+                break
+            yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    finally:
+        video_cap.release()
+
+
+def _decode(path, first, count, decoded, stop, metrics=None):
+    frames = decode_frames(path, first, count)
+    while True:
+        with stage(metrics, 'decode'):
+            frame = next(frames, _END)
+        if frame is _END:
+            break
+        if not _put(decoded, frame, stop):
+            return
+    _put(decoded, _END, stop)
+
+
+class VideoJob:
+    """
+    Job folder where a video is encoded in chunks of chunk_frames frames.
+
+    manifest.json lists the committed chunks, it is rewritten atomically after each chunk is closed, so
+    after a crash or cancellation the job resumes from the first frame that was not committed.
+    A folder whose manifest belongs to other parameters is started over.
+    With segments (see video_segments) chunk i holds segment i instead of chunk_frames frames, written to a
+    file named after the run (see segment_path).
+    """
+    def __init__(self, folder: str, path: str, start: int, end: int, fps: float, chunk_frames: int = CHUNK_FRAMES,
+                 segments: list = None) -> None:
+        self.folder = folder
+        self.params = {'path': os.path.abspath(path), 'start': start, 'end': end, 'fps': fps, 'chunk_frames': chunk_frames}
+        if segments is not None:
+            self.params['segments'] = [list(segment) for segment in segments]
+        self.chunk_frames = chunk_frames
+        self.fps = fps
+        self.chunks = []
+
+        manifest = self._read_manifest()
+        if manifest is not None and manifest['params'] == self.params:
+            self.chunks = manifest['chunks']
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
+
+        os.makedirs(folder, exist_ok=True)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.folder, 'manifest.json')
+
+    @property
+    def committed_frames(self) -> int:
+        return sum(chunk['frames'] for chunk in self.chunks)
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def chunk_path(self, index: int) -> str:
+        return os.path.join(self.folder, f'chunk_{index:05d}.mp4')
+
+    def segment_path(self, index: int, run: str) -> str:
+        # Workers of a cancelled run may still be encoding its segments, a new run never opens their files
+        return os.path.join(self.folder, f'segment_{index:05d}_{run}.mp4')
+
+    def commit(self, frames: int, path: str = None) -> None:
+        path = path or self.chunk_path(len(self.chunks))
+        self.chunks.append({'file': os.path.basename(path), 'frames': frames})
+
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'params': self.params, 'chunks': self.chunks}, f, indent=2)
+        os.replace(temp_path, self.manifest_path)
+
+    def concat(self, output_path: str, audiofile: str = None) -> None:
+        # Join the chunks without re-encoding and mux the audio track in
+        from moviepy.config import get_setting
+
+        list_path = os.path.join(self.folder, 'chunks.txt')
+        with open(list_path, 'w') as f:
+            for chunk in self.chunks:
+                f.write(f"file '{chunk['file']}'\n")
+
+        command = [get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error', '-f', 'concat', '-safe', '0', '-i', list_path]
+        if audiofile is not None:
+            command += ['-i', audiofile, '-map', '0:v', '-map', '1:a', '-shortest']
+        command += ['-c', 'copy', output_path]
+
+        subprocess.run(command, check=True)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+
+def _encode(upscaled, job, stop, metrics=None):
+    # moviepy is only loaded by the first video job
+    from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+    writer = None
+    frames = 0
+    try:
+        while True:
+            frame = _get(upscaled, stop)
+            if frame is _END:
+                break
+
+            with stage(metrics, 'encode'):
+                if writer is None:
+                    writer = FFMPEG_VideoWriter(job.chunk_path(len(job.chunks)), frame.size, job.fps, codec='libx264')
+                writer.write_frame(np.asarray(frame))
+                frames += 1
+
+                if frames == job.chunk_frames:
+                    writer.close()
+                    job.commit(frames)
+                    writer, frames = None, 0
+    finally:
+        if writer is not None:
+            writer.close()
+            # The last chunk is committed when the stream ended, a stopped pipeline leaves it out
+            if not stop.is_set():
+                job.commit(frames)
+
+
+def _extract_audio(path: str, start: int, end: int, fps: float, folder: str):
+    # Writes the subclip audio track to a temporary file for the encoder, None if there is no audio
+    from moviepy.audio.io.AudioFileClip import AudioFileClip
+    from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+    try:
+        if not ffmpeg_parse_infos(path).get('audio_found'):
+            return None
+        audio = AudioFileClip(path)
+    except (IOError, KeyError):
+        return None
+
+    audiofile = os.path.join(folder, 'audio.mp3')
+    audio.subclip(start / fps, end / fps).write_audiofile(audiofile, logger=None)
+    audio.close()
+    return audiofile
+
+
+def stream_video(path: str, start: int, end: int, output_path: str, process, on_frame=None, job_folder: str = None,
+                 metrics=None, queue_size: int = PIPELINE_QUEUE_SIZE) -> int:
+    """
+    Upscale frames [start, end) of a video into output_path with constant memory.
+
+    A decoder thread, the calling thread (process, which maps an iterable of input frames to
+    output frames) and an encoder thread are connected by bounded queues, output is encoded in
+    chunks as frames finish and the chunks are joined at the end. With a job_folder the committed
+    chunks survive a failure and the next call with the same arguments resumes after them.
+    metrics, a metrics.Metrics, gets the decode, encode and mux times. Returns the number of frames written.
+    """
+    video_cap = cv2.VideoCapture(path)
+    fps = video_cap.get(cv2.CAP_PROP_FPS)
+    video_cap.release()
+
+    resumable = job_folder is not None
+    job = VideoJob(job_folder if resumable else tempfile.mkdtemp(), path, start, end, fps)
+
+    decoded = queue.Queue(maxsize=queue_size)
+    upscaled = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    try:
+        count = job.committed_frames
+        if count and on_frame is not None:
+            on_frame(count)
+
+        # Resume after the committed frames, in 0-based frames
+        decoder = _Stage(stop, _decode, path, first_frame(start) + count, end - start - count, decoded, stop, metrics)
+        encoder = _Stage(stop, _encode, upscaled, job, stop, metrics)
+        decoder.start()
+        encoder.start()
+
+        try:
+            frames = iter(lambda: _get(decoded, stop), _END)
+            for output in process(frames):
+                if not _put(upscaled, output, stop):
+                    break
+                count += 1
+
+                if on_frame is not None:
+                    on_frame(count)
+
+            _put(upscaled, _END, stop)
+            encoder.join()
+        finally:
+            stop.set()
+            decoder.join()
+            encoder.join()
+
+        for thread in (decoder, encoder):
+            if thread.error is not None:
+                raise thread.error
+
+        if job.chunks:
+            with stage(metrics, 'mux'):
+                job.concat(output_path, _extract_audio(path, start, end, fps, job.folder))
+    except BaseException:
+        if not resumable:
+            job.remove()
+        raise
+
+    job.remove()
+    return count
+
+
+def video_segments(path: str, start: int, end: int, fps: float, min_frames: int = SEGMENT_MIN_FRAMES) -> list:
+    """
+    Split the subclip [start, end) at keyframes into (first, last) pairs of 0-based frames, last excluded,
+    so every segment decodes on its own from its first frame. Segments are at least min_frames long,
+    the keyframes closer than that to the previous cut are skipped.
+    """
+    first = first_frame(start)
+    last = first + end - start
+
+    bounds = [first]
+    for keyframe in keyframe_index(path, fps):
+        if keyframe - bounds[-1] >= min_frames and last - keyframe >= min_frames:
+            bounds.append(keyframe)
+    bounds.append(last)
+
+    return list(zip(bounds, bounds[1:]))
+
+
+def encode_segment(path: str, first: int, last: int, output_path: str, fps: float, process, metrics=None,
+                   queue_size: int = PIPELINE_QUEUE_SIZE) -> int:
+    # Upscale the 0-based frames [first, last) into a single file without audio, one segment of segment_video
+    from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
+
+    decoded = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    decoder = _Stage(stop, _decode, path, first, last - first, decoded, stop, metrics)
+    decoder.start()
+
+    writer = None
+    count = 0
+    try:
+        for output in process(iter(lambda: _get(decoded, stop), _END)):
+            with stage(metrics, 'encode'):
+                if writer is None:
+                    writer = FFMPEG_VideoWriter(output_path, output.size, fps, codec='libx264')
+                writer.write_frame(np.asarray(output))
+            count += 1
+    finally:
+        stop.set()
+        decoder.join()
+        if writer is not None:
+            writer.close()
+
+    if decoder.error is not None:
+        raise decoder.error
+    return count
+
+
+def segment_video(path: str, start: int, end: int, output_path: str, run_segments, on_frame=None,
+                  job_folder: str = None, metrics=None) -> int:
+    """
+    Upscale frames [start, end) of a video as segments split at keyframes (see video_segments), each one
+    decoded, upscaled and encoded by its own worker, so long videos scale with the number of workers.
+
+    run_segments takes a list of (path, first, last, output_path, fps) segments and yields the frames written for
+    each of them, in order (see worker_pool.InferencePool.segments). The segment files are joined without
+    re-encoding and the audio muxed in, as the chunks of stream_video. With a job_folder the finished
+    segments survive a failure and are skipped by the next call. Returns the number of frames written.
+    """
+    video_cap = cv2.VideoCapture(path)
+    fps = video_cap.get(cv2.CAP_PROP_FPS)
+    video_cap.release()
+
+    segments = video_segments(path, start, end, fps)
+    resumable = job_folder is not None
+    job = VideoJob(job_folder if resumable else tempfile.mkdtemp(), path, start, end, fps, segments=segments)
+
+    try:
+        count = job.committed_frames
+        if count and on_frame is not None:
+            on_frame(count)
+
+        done = len(job.chunks)
+        run = uuid.uuid4().hex[:8]
+        tasks = [(path, first, last, job.segment_path(i, run), fps) for i, (first, last) in enumerate(segments)][done:]
+
+        for task, frames in zip(tasks, run_segments(tasks)):
+            # Segments come back in order, so the manifest always lists a prefix of them
+            if frames:
+                job.commit(frames, task[3])
+            count += frames
+
+            if on_frame is not None:
+                on_frame(count)
+
+        if job.chunks:
+            with stage(metrics, 'mux'):
+                job.concat(output_path, _extract_audio(path, start, end, fps, job.folder))
+    except BaseException:
+        if not resumable:
+            job.remove()
+        raise
+
+    job.remove()
+    return count
@@ -0,0 +1,81 @@
+import argparse
+import os
+import sys
+
+import torch
+
+from models.network_rrdbnet import fold_residual_scaling
+from config import MODELS, MMAP_SUFFIX
+
+
+def checkpoint_path(model_name: str) -> str:
+    return os.path.join('model_zoo', f'{model_name}.pth')
+
+
+def mmap_path(model_name: str) -> str:
+    return os.path.join('model_zoo', f'{model_name}{MMAP_SUFFIX}')
+
+
+def convert_checkpoint(model_name: str) -> str:
+    """
+    Rewrite a model_zoo checkpoint as a state dict of contiguous tensors in torch's zip format, whose tensor
+    data torch.load can memory-map instead of unpickling it. The residual scaling of the dense blocks is folded
+    in (see RRDBNet.enable_dense_execution), so no process writes to the mapped pages. Returns the converted path.
+    """
+    state = torch.load(checkpoint_path(model_name), map_location='cpu', weights_only=True)
+    state = {name: tensor.contiguous() for name, tensor in fold_residual_scaling(state).items()}
+
+    # Several workers may convert at once, each one writes its own file and the last rename wins
+    path = mmap_path(model_name)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save({'state_dict': state, 'res_scale_folded': True}, temp_path)
+    os.replace(temp_path, path)
+    return path
+
+
+def load_weights(model_name: str) -> dict:
+    """
+    State dict of a model, with the residual scaling folded, backed by the memory-mapped converted file.
+    It is converted on first use, when the checkpoint is newer or when the file predates the folding.
+    Pages are read on demand and shared by every process mapping the file.
+    """
+    path = mmap_path(model_name)
+    checkpoint = checkpoint_path(model_name)
+
+    if not os.path.exists(path) or (os.path.exists(checkpoint) and os.path.getmtime(checkpoint) > os.path.getmtime(path)):
+        convert_checkpoint(model_name)
+
+    weights = torch.load(path, mmap=True, map_location='cpu', weights_only=True)
+    if not weights.get('res_scale_folded'):
+        convert_checkpoint(model_name)
+        weights = torch.load(path, mmap=True, map_location='cpu', weights_only=True)
+    return weights['state_dict']
+
+
+def weights_identity(model_name: str) -> str:
+    # Changes whenever the converted file is rewritten, for the keys of what is derived from the weights
+    stat = os.stat(mmap_path(model_name))
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Convert model_zoo checkpoints to the memory-mapped weight format')
+    parser.add_argument('models', nargs='*', choices=MODELS, help='models to convert, all the available ones by default')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    models = args.models or [model for model in MODELS if os.path.exists(checkpoint_path(model))]
+
+    if not models:
+        print('No checkpoints found in model_zoo', file=sys.stderr)
+        return 1
+
+    for model_name in models:
+        print(f'Saved {convert_checkpoint(model_name)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,40 @@
 import tkinter as tk
 
+from collections import OrderedDict
+
 from tkinter import ttk
 from PIL import ImageTk, Image
-from config import PRIMARY_BG
+from config import PRIMARY_BG, PYRAMID_MIN_SIZE, PYRAMID_CACHE, RESIZE_DELAY, PREVIEW_MIN_SIZE
 from card import Card
 
 
+class PreviewPyramid:
+    """
+    Copies of an image halved down to min_size, built once. resize starts from the smallest level that
+    is still at least the requested size, so showing a huge output in a small window stays cheap.
+    """
+    def __init__(self, image: Image.Image, min_size: int = PYRAMID_MIN_SIZE) -> None:
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGBA' if 'transparency' in image.info or image.mode in ('LA', 'PA') else 'RGB')
+
+        self.levels = [image]
+        while max(self.levels[-1].size) // 2 >= min_size:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    @property
+    def size(self) -> tuple:
+        return self.levels[0].size
+
+    def resize(self, size: tuple) -> Image.Image:
+        level = self.levels[0]
+        for candidate in self.levels[1:]:
+            if candidate.size[0] < size[0] or candidate.size[1] < size[1]:
+                break
+            level = candidate
+
+        return level if level.size == size else level.resize(size)
+
+
 class WorkArea(tk.Frame):
     def __init__(self, parent: tk.Frame, *args, **kwargs):
         tk.Frame.__init__(self, parent, *args, **kwargs)
@@ -21,68 +50,105 @@ class WorkArea(tk.Frame):
         self.btn_close = None
         self.btn_reset = None
         self.btn_see_original = None
-        self.image_showing = None
+        self.image_showing = None  # Image (PIL), the card's file or output, or a preview
         self.resized_image_showing = None
-        self.lbl_image = ttk.Label(self)
-        self.lbl_image.config(image = self.resized_image_showing)
-        
+        self.image_canvas = tk.Canvas(self, background=PRIMARY_BG, highlightthickness=0, cursor='crosshair')
+        self.image_item = self.image_canvas.create_image(0, 0, anchor='nw')
+        self.selection_item = self.image_canvas.create_rectangle(0, 0, 0, 0, outline='white', dash=(4, 2), state='hidden')
+
+        # Region selected for a preview, in image pixels
+        self.selection = None
+        self.drag_start = None
+        self.region_trigger = None
+        self.image_canvas.bind('<ButtonPress-1>', self.start_selection)
+        self.image_canvas.bind('<B1-Motion>', self.drag_selection)
+        self.image_canvas.bind('<ButtonRelease-1>', self.end_selection)
+        self.image_canvas.bind('<Button-3>', lambda _: self.clear_selection())
+
+        self.pyramids = OrderedDict()  # id(image) -> (image, PreviewPyramid)
+        self.shown = None  # (image, size) on screen, to skip resizes that change nothing
+        self.pending_resize = None  # after() id of the debounced resize
+
         self.buttons_bar = tk.Frame(self, background=PRIMARY_BG)
+        self.lbl_status = ttk.Label(self, background=PRIMARY_BG, foreground='white')  # See show_status
 
-        self.bind('<Configure>', self.resize_image)
+        self.bind('<Configure>', self.schedule_resize)
 
         self.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
-    
+
     def is_upscaled(self):
         return self.card.image['output'] is not None
-    
+
     def toggle_image(self):
         # Changes showing image between original and output
-        if self.card.image['photoImage'] == self.image_showing:
+        if self.card.image['file'] is self.image_showing:
             self.image_showing = self.card.image['output']
             new_icon = self.visible_icon
         else:
-            self.image_showing = self.card.image['photoImage']
+            self.image_showing = self.card.image['file']
             new_icon = self.invisible_icon
-            
+
         self.btn_see_original.config(image=new_icon)
         self.resize_image(None)
-    
+
     def reset_image(self):
-        self.image_showing = self.card.image['photoImage']
+        self.image_showing = self.card.image['file']
         self.btn_see_original.config(image=self.visible_icon)
         self.resize_image(None)
 
     def close_file(self):
-        self.lbl_image.place_forget()
+        self.image_canvas.place_forget()
         self.btn_close.place_forget()
         self.buttons_bar.place_forget()
         self.btn_open.place(relx=0.5, rely=0.5)
         self.btn_see_original.config(image=self.visible_icon)
         self.card = None
+        self.image_showing = None
+        self.shown = None
+        self.selection = None
+        self.show_status('')
 
     def show_image(self):
         if self.card is None:
             return
-        
+
         self.btn_open.place_forget()
 
-        self.lbl_image.place(relx=0.5, rely=0.5, anchor='center')
+        self.image_canvas.place(relx=0.5, rely=0.5, anchor='center')
         self.btn_close.place(relx=1, rely=1, anchor='se')
         self.buttons_bar.place(relx=1, rely=0, anchor='ne')
 
         self.resize_image(None)
-    
+
+    def pyramid(self, image: Image.Image) -> PreviewPyramid:
+        key = id(image)
+        if key in self.pyramids and self.pyramids[key][0] is image:
+            self.pyramids.move_to_end(key)
+        else:
+            self.pyramids[key] = image, PreviewPyramid(image)
+            while len(self.pyramids) > PYRAMID_CACHE:
+                self.pyramids.popitem(last=False)
+        return self.pyramids[key][1]
+
+    def schedule_resize(self, _):
+        # <Configure> fires continuously while the window is dragged, only the last one resizes
+        if self.pending_resize is not None:
+            self.after_cancel(self.pending_resize)
+        self.pending_resize = self.after(RESIZE_DELAY, self.resize_image, None)
+
     def resize_image(self, _):
+        self.pending_resize = None
+
         if self.image_showing is None:
             return
-        
+
         padding = 50
         # Get image
-        image = ImageTk.getimage(self.image_showing)
+        pyramid = self.pyramid(self.image_showing)
 
         # Calculate new size
         parent_size = max(self.winfo_width() - padding, padding), max(self.winfo_height() - padding, padding)
-        image_size = image.size
+        image_size = pyramid.size
         image_ratio = image_size[0] / image_size[1]
 
         new_size = parent_size[0], round(parent_size[0] / image_ratio)
@@ -90,28 +156,109 @@ class WorkArea(tk.Frame):
         if new_size[1] > parent_size[1]:
             new_size = round(parent_size[1] * image_ratio), parent_size[1]
 
-        # Resize and update image
-        new_image = image.resize(new_size)
-        new_image_tk = ImageTk.PhotoImage(new_image)
-        self.resized_image_showing = new_image_tk
+        # By identity, comparing PIL images with == compares their pixels
+        if self.shown is None or self.shown[0] is not self.image_showing or self.shown[1] != new_size:
+            self.shown = self.image_showing, new_size
+
+            # Resize and update image
+            new_image_tk = ImageTk.PhotoImage(pyramid.resize(new_size))
+            self.resized_image_showing = new_image_tk
+
+            # Update canvas to refresh image
+            self.image_canvas.config(width=new_size[0], height=new_size[1])
+            self.image_canvas.itemconfigure(self.image_item, image=self.resized_image_showing)
+
+        self.draw_selection()
+
+    #########################################  SELECTION  #####################################
+    def display_scale(self) -> float:
+        # Image pixels per displayed pixel
+        return self.pyramid(self.image_showing).size[0] / self.shown[1][0]
+
+    def start_selection(self, event):
+        if self.shown is None:
+            return
+        self.drag_start = event.x, event.y
+        self.image_canvas.coords(self.selection_item, event.x, event.y, event.x, event.y)
+        self.image_canvas.itemconfigure(self.selection_item, state='normal')
+
+    def drag_selection(self, event):
+        if self.drag_start is None:
+            return
+        w, h = self.shown[1]
+        x, y = min(max(event.x, 0), w), min(max(event.y, 0), h)
+        self.image_canvas.coords(self.selection_item, *self.drag_start, x, y)
+
+    def end_selection(self, _):
+        if self.drag_start is None:
+            return
+        self.drag_start = None
+
+        # Display coordinates to image pixels
+        x0, y0, x1, y1 = self.image_canvas.coords(self.selection_item)
+        scale = self.display_scale()
+        box = tuple(round(v * scale) for v in (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)))
+
+        if box[2] - box[0] < PREVIEW_MIN_SIZE or box[3] - box[1] < PREVIEW_MIN_SIZE:
+            self.clear_selection()
+            return
+
+        self.selection = box
+        if self.region_trigger is not None:
+            self.region_trigger(box)
+
+    def draw_selection(self):
+        if self.selection is None or self.drag_start is not None:
+            self.image_canvas.itemconfigure(self.selection_item, state='hidden' if self.drag_start is None else 'normal')
+            return
+
+        scale = self.display_scale()
+        self.image_canvas.coords(self.selection_item, *(v / scale for v in self.selection))
+        self.image_canvas.itemconfigure(self.selection_item, state='normal')
+
+    def clear_selection(self):
+        # Drops the region and its preview
+        self.selection = None
+        self.drag_start = None
+        if self.card is not None:
+            self.update_image(self.card)
+        else:
+            self.draw_selection()
+
+    def show_preview(self, image: Image.Image, box: tuple):
+        # Image with the upscaled region pasted in place, box is the region in image pixels
+        self.image_showing = image
+        self.selection = box
+        self.resize_image(None)
+
+    def show_status(self, text: str):
+        # One line under the image, about the image shown (a failed preview...), hidden when empty
+        if text:
+            self.lbl_status.config(text=text)
+            self.lbl_status.place(relx=0, rely=1, anchor='sw')
+        else:
+            self.lbl_status.place_forget()
 
-        # Update label to refresh image
-        self.lbl_image.config(image = self.resized_image_showing)
-    
     #########################################  EVENTS  ########################################
     def update_image(self, card: Card):
         self.card = card
-        self.image_showing = card.image['output'] if card.image['output'] is not None else card.image['photoImage']
+        self.selection = None
+        self.show_status('')
+        self.image_showing = card.image['output'] if card.image['output'] is not None else card.image['file']
         self.btn_see_original.config(image=self.visible_icon)
         self.resize_image(None)
-    
+
+    def on_region_selected(self, fn):
+        # fn(box) with the selected (left, top, right, bottom) in image pixels
+        self.region_trigger = fn
+
     def on_file_open(self, fn):
         self.btn_open = ttk.Button(self, text='Open', command=fn, cursor='hand2')
         self.btn_open.place(relx=0.5, rely=0.5)
-    
+
     def on_file_close(self, fn):
         self.btn_close = ttk.Button(self, image=self.close_icon, command=fn, cursor='hand2')
-    
+
     def on_reset(self, fn):
         self.btn_reset = ttk.Button(self.buttons_bar, image=self.reset_icon, command=fn, cursor='hand2')
         self.btn_reset.pack(side=tk.RIGHT)
@@ -0,0 +1,222 @@
+import os
+import queue
+
+import torch
+
+from config import POOL_CHUNK_SIZE
+from metrics import Metrics, stage
+
+
+def cpu_cores() -> list:
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def device_names() -> list:
+    # Names of the CUDA devices, empty without CUDA
+    return [torch.cuda.get_device_properties(i).name for i in range(torch.cuda.device_count())]
+
+
+def resolve_devices(spec: str, workers: int = None) -> list:
+    """
+    Turn a device spec into one (device, cores) placement per worker.
+
+    'cuda' uses every CUDA device, 'cuda:0,cuda:2' the listed ones, and 'cpu' or 'cpu:N' runs
+    N CPU workers (default `workers` or 1) pinned to disjoint core sets. cores is None for CUDA.
+    """
+    spec = spec.strip().lower()
+
+    if spec.startswith('cpu'):
+        count = int(spec.split(':')[1]) if ':' in spec else (workers or 1)
+        cores = cpu_cores()
+        count = max(1, min(count, len(cores)))
+        per_worker = len(cores) // count
+        return [('cpu', cores[i * per_worker:(i + 1) * per_worker]) for i in range(count)]
+
+    if spec == 'cuda':
+        devices = [f'cuda:{i}' for i in range(torch.cuda.device_count())]
+    else:
+        devices = [device.strip() for device in spec.split(',')]
+
+    if not devices:
+        raise ValueError(f'No devices found for "{spec}"')
+
+    # Several workers may share a device when more workers than devices are requested
+    workers = max(workers or len(devices), len(devices))
+    return [(devices[i % len(devices)], None) for i in range(workers)]
+
+
+def pin_worker(device: str, cores: list = None) -> None:
+    # Bind the current process to its device or core set
+    if cores:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+
+    if device.startswith('cuda'):
+        torch.cuda.set_device(torch.device(device))
+
+
+def _worker_main(model_name, device, cores, tasks, results):
+    from ai import load_model, model_scale, upscale_frames
+    from video_pipeline import encode_segment
+
+    pin_worker(device, cores)
+    model = load_model(model_name, device)
+    sf = model_scale(model_name)
+
+    with torch.no_grad():
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+
+            generation, seq, kind, payload, options = task
+            metrics = Metrics(device)
+            try:
+                if kind == 'segment':
+                    # Decoded, upscaled and encoded here, only the frame and pixel counts go back
+                    path, first, last, output_path, fps = payload
+                    encode_segment(path, first, last, output_path, fps,
+                                   lambda frames: upscale_frames(model, frames, sf, device, options, metrics), metrics)
+                    outputs = metrics.frames, metrics.pixels
+                else:
+                    outputs = list(upscale_frames(model, payload, sf, device, options, metrics))
+                results.put((generation, seq, outputs, metrics.stages(), None))
+            except Exception as e:
+                results.put((generation, seq, None, None, f'{type(e).__name__}: {e}'))
+            finally:
+                metrics.close()
+
+
+class InferencePool:
+    """
+    Inference worker processes spread over devices, see resolve_devices for the placements.
+
+    map shards a stream of frames into chunks, runs them on whichever worker is free and yields
+    the outputs back in input order, with at most two chunks per worker in flight. segments hands
+    whole video segments to the workers, which decode and encode them too.
+    """
+    def __init__(self, model_name: str, placements: list, chunk_size: int = POOL_CHUNK_SIZE) -> None:
+        ctx = torch.multiprocessing.get_context('spawn')
+        self.model_name = model_name
+        self.placements = placements
+        self.chunk_size = chunk_size
+        self.tasks = ctx.Queue()
+        self.results = ctx.Queue()
+        self.workers = []
+        self.generation = 0  # Tells apart results of an abandoned map call
+
+        for device, cores in placements:
+            worker = ctx.Process(target=_worker_main, args=(model_name, device, cores, self.tasks, self.results), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def __len__(self) -> int:
+        return len(self.workers)
+
+    def _chunks(self, frames):
+        chunk = []
+        for frame in frames:
+            chunk.append(frame)
+            if len(chunk) == self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _result(self, idle=None):
+        # idle() is called about every 100 ms while waiting
+        waited = 0
+        while True:
+            try:
+                return self.results.get(timeout=0.1 if idle is not None else 1)
+            except queue.Empty:
+                waited += 1
+                if idle is not None:
+                    idle()
+                if (idle is None or waited % 10 == 0) and not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError('An inference worker died')
+
+    def map(self, frames, options: dict, metrics=None):
+        # metrics gets the stage times of the workers, plus the time spent sending them frames as 'ipc'
+        self.generation += 1
+        generation = self.generation
+        max_pending = 2 * len(self.workers)
+        pending = {}  # seq -> outputs, finished out of order
+        sent, next_seq = 0, 0
+
+        chunks = self._chunks(frames)
+        exhausted = False
+
+        while not exhausted or next_seq < sent:
+            # Keep every worker busy without reading the whole input
+            while not exhausted and sent - next_seq < max_pending:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                with stage(metrics, 'ipc'):
+                    self.tasks.put((generation, sent, 'frames', chunk, options))
+                sent += 1
+
+            if next_seq == sent:
+                continue
+
+            result_generation, seq, outputs, stages, error = self._result()
+            if result_generation != generation:
+                continue
+            if error is not None:
+                raise RuntimeError(f'Chunk {seq} failed: {error}')
+            pending[seq] = outputs
+
+            if metrics is not None:
+                metrics.merge(stages)
+                metrics.count(len(outputs), sum(output.width * output.height for output in outputs))
+
+            # Reassemble in order
+            while next_seq in pending:
+                yield from pending.pop(next_seq)
+                next_seq += 1
+
+    def segments(self, segments: list, options: dict, metrics=None, idle=None):
+        """
+        Run video segments, (path, first, last, output_path, fps) tuples, one per worker at a time, and
+        yield the frames written for each of them in order. idle is called while waiting for the workers,
+        so the caller can stop (by raising) or do other work in between.
+        """
+        self.generation += 1
+        generation = self.generation
+        pending = {}  # seq -> frames, finished out of order
+        sent, next_seq = 0, 0
+
+        while next_seq < len(segments):
+            # One segment per worker, so an abandoned call leaves little work behind
+            while sent < len(segments) and sent - next_seq < len(self.workers):
+                self.tasks.put((generation, sent, 'segment', segments[sent], options))
+                sent += 1
+
+            result_generation, seq, outputs, stages, error = self._result(idle)
+            if result_generation != generation:
+                continue
+            if error is not None:
+                raise RuntimeError(f'Segment {seq} failed: {error}')
+
+            frames, pixels = outputs
+            pending[seq] = frames
+            if metrics is not None:
+                metrics.merge(stages)
+                metrics.count(frames, pixels)
+
+            while next_seq in pending:
+                yield pending.pop(next_seq)
+                next_seq += 1
+
+    def close(self) -> None:
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()